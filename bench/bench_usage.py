@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""用量链路基准：在本地 chat-usage 模拟服务上，按 10/100/1000 个 key 测量
+decrypt_keys、refresh_usages（异步刷新引擎）、write_cache 与 HTTP 接口的 p50/p99 与吞吐
+
+    python3 bench/bench_usage.py
+    python3 bench/bench_usage.py --sizes 1000 --latency 0.05 --jitter 0.05 --throttle-rate 0.02
+    python3 bench/bench_usage.py --save base.json             # 保存基线
+    python3 bench/bench_usage.py --baseline base.json         # 与基线对比，回退超过 --tolerance 时退出码为 1
+
+不访问真实上游，不读写 ~/.oroio：所有数据放在临时目录中，结束后删除。
+"""
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from upstream_stub import SHAPES, start_stub  # noqa: E402
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class Result:
+    """一项测量：samples 为单次操作耗时（秒），items 为这些操作共处理的条目数（key 或请求）"""
+    def __init__(self, name: str, size: int, samples: list, items: int, wall: float):
+        self.name = name
+        self.size = size
+        self.samples = samples
+        self.items = items
+        self.wall = wall
+
+    @property
+    def key(self) -> str:
+        return f'{self.name}@{self.size}'
+
+    def summary(self) -> dict:
+        return {
+            'p50_ms': percentile(self.samples, 50) * 1000,
+            'p99_ms': percentile(self.samples, 99) * 1000,
+            'mean_ms': statistics.fmean(self.samples) * 1000 if self.samples else 0.0,
+            'throughput': self.items / self.wall if self.wall > 0 else 0.0,
+            'runs': len(self.samples),
+        }
+
+
+def measure(name: str, size: int, fn, repeat: int, items_per_run: int) -> Result:
+    samples = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return Result(name, size, samples, items_per_run * repeat, time.perf_counter() - started)
+
+
+def measure_http(name: str, size: int, port: int, method: str, path: str, body: dict,
+                 requests: int, clients: int) -> Result:
+    """clients 个并发客户端，每个复用一个 HTTPConnection。
+    线程池满时服务端会关闭空闲的持久连接，此时与浏览器一样重连并重发一次（计入该次耗时）"""
+    payload = json.dumps(body).encode('utf-8') if body is not None else None
+    headers = {'Content-Type': 'application/json'} if payload is not None else {}
+    per_client = max(1, requests // clients)
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        samples = []
+        try:
+            for _ in range(per_client):
+                t = time.perf_counter()
+                try:
+                    conn.request(method, path, body=payload, headers=headers)
+                    resp = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    conn.request(method, path, body=payload, headers=headers)
+                    resp = conn.getresponse()
+                resp.read()
+                samples.append(time.perf_counter() - t)
+                if resp.status >= 400:
+                    raise RuntimeError(f'{method} {path} -> {resp.status}')
+        finally:
+            conn.close()
+        return samples
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda _: client(), range(clients)))
+    wall = time.perf_counter() - started
+    samples = [s for r in results for s in r]
+    return Result(name, size, samples, len(samples), wall)
+
+
+def bench_size(serve, size: int, args) -> list:
+    workdir = tempfile.mkdtemp(prefix=f'oroio-bench-{size}-')
+    oroio_dir = os.path.join(workdir, 'oroio')
+    web_dir = os.path.join(workdir, 'web')
+    os.makedirs(oroio_dir)
+    os.makedirs(web_dir)
+    keys_file = os.path.join(oroio_dir, 'keys.enc')
+    cache_file = os.path.join(oroio_dir, 'list_cache.b64')
+    keys = [f'fk-bench-{size}-{i:05d}' for i in range(size)]
+    results = []
+    try:
+        serve.encrypt_keys(keys, keys_file)
+
+        # keys.enc：冷读取（每次真正解密）与热读取（签名未变时走内存缓存）
+        results.append(measure('decrypt_keys.cold', size, lambda: serve._read_key_records(keys_file),
+                               args.repeat, size))
+        results.append(measure('decrypt_keys.warm', size, lambda: serve.decrypt_keys(keys_file),
+                               args.repeat * 10, size))
+
+        # 上游刷新：常驻异步引擎（/api/refresh、后台轮询与 dk 共用）
+        usages = []
+        results.append(measure('refresh_usages', size, lambda: usages.__setitem__(slice(None), serve.refresh_usages(keys)),
+                               args.repeat, size))
+
+        results.append(measure('write_cache', size, lambda: serve.write_cache(keys_file, cache_file, keys, usages),
+                               args.repeat * 5, size))
+
+        # HTTP 接口：先把 usage 缓存填满，再测只读接口与一次完整的强制刷新
+        cache = serve.get_usage_cache(oroio_dir)
+        serve.refresh_usage_cache(cache, keys_file, cache_file, keys, force=True)
+        handler = lambda *a, **kw: serve.OroioHandler(*a, oroio_dir=oroio_dir, dk_path='dk', directory=web_dir, **kw)
+        # 与 serve.run() 相同的服务器：固定 worker 池 + 有界等待队列 + 持久连接
+        server = serve.PooledHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            for name, method, path, body in (
+                ('GET /api/usage', 'GET', '/api/usage', None),
+                ('POST /api/rotate', 'POST', '/api/rotate', {'apply': False}),
+                ('GET /metrics', 'GET', '/metrics', None),
+            ):
+                results.append(measure_http(name, size, port, method, path, body, args.requests, args.clients))
+            results.append(measure_http('POST /api/refresh(force)', size, port, 'POST', '/api/refresh',
+                                        {'force': True, 'wait': True}, args.repeat, 1))
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """p99 变慢或吞吐下降超过 tolerance（比例）的项"""
+    regressions = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if base['p99_ms'] > 0 and cur['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p99 {base['p99_ms']:.2f}ms -> {cur['p99_ms']:.2f}ms")
+        if base['throughput'] > 0 and cur['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {base['throughput']:.0f}/s -> {cur['throughput']:.0f}/s")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the oroio usage pipeline against a local upstream stub')
+    parser.add_argument('--sizes', default='10,100,1000', help='comma separated key pool sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per pipeline measurement')
+    parser.add_argument('--requests', type=int, default=200, help='requests per HTTP endpoint')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--latency', type=float, default=0.005, help='stub latency per request (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='stub extra random latency (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='stub 5xx fraction')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='stub 429 fraction')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='stub requests/s before 429 (0 = unlimited)')
+    parser.add_argument('--retry-after', type=float, default=0.05, help='stub Retry-After seconds on 429')
+    parser.add_argument('--shape', choices=SHAPES + ('mixed',), default='mixed')
+    parser.add_argument('--workers', type=int, help='server worker threads (default: DKM_SERVE_WORKERS or 16)')
+    parser.add_argument('--queue', type=int, help='server accept queue (default: DKM_SERVE_QUEUE or 64)')
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare against a JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression ratio vs baseline')
+    args = parser.parse_args()
+
+    stub, stub_config = start_stub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                   throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+                                   retry_after=args.retry_after, shape=args.shape)
+    # serve.py 在导入时读取这些配置，必须先设置
+    os.environ['DKM_API_BASE'] = f'http://127.0.0.1:{stub.server_address[1]}'
+    os.environ.setdefault('DKM_POLL_INTERVAL', '0')
+    if args.workers:
+        os.environ['DKM_SERVE_WORKERS'] = str(args.workers)
+    if args.queue:
+        os.environ['DKM_SERVE_QUEUE'] = str(args.queue)
+    sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bin'))
+    import serve
+
+    print(f"{'benchmark':<28}{'keys':>6}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'items/s':>12}{'runs':>6}")
+    summaries = {}
+    for size in [int(s) for s in args.sizes.split(',') if s.strip()]:
+        for result in bench_size(serve, size, args):
+            s = summaries[result.key] = result.summary()
+            print(f"{result.name:<28}{size:>6}{s['p50_ms']:>10.2f}{s['p99_ms']:>10.2f}{s['mean_ms']:>10.2f}"
+                  f"{s['throughput']:>12.0f}{s['runs']:>6}", flush=True)
+    print(f'upstream stub: {json.dumps(stub_config.stats)}')
+    stub.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summaries, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summaries, json.load(f), args.tolerance)
+        if regressions:
+            print('regressions:')
+            for line in regressions:
+                print(f'  {line}')
+            return 1
+        print('no regressions vs baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""chat-usage 接口的本地模拟服务，供 bench_usage.py 与手工压测使用
+
+    python3 bench/upstream_stub.py --port 18999 --latency 0.05 --error-rate 0.02 --rate-limit 200
+    DKM_API_BASE=http://127.0.0.1:18999 dk list
+
+响应按 key 决定：以 bad 开头返回 401，以 empty 开头返回已耗尽的额度，其余按 --shape 生成用量。
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+
+SHAPES = ('standard', 'premium', 'total', 'main')
+API_PATH = '/api/organization/members/chat-usage'
+
+
+def usage_body(key: str, shape: str) -> dict:
+    """生成 parse_usage 可解析的响应；不同 shape 使用各自的字段名"""
+    digest = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+    if shape == 'mixed':
+        shape = SHAPES[digest % len(SHAPES)]
+    total = 20_000_000
+    used = total if key.startswith('empty') else digest % total
+    end_date = int(time.time() + 30 * 86400) * 1000
+    if shape == 'standard':
+        section = {'totalAllowance': total, 'orgTotalTokensUsed': used, 'orgOverageUsed': 0}
+    elif shape == 'premium':
+        section = {'basicAllowance': total, 'used': used}
+    elif shape == 'total':
+        section = {'allowance': total, 'tokensUsed': used}
+        return {'usage': {shape: section, 'expires_at': time.strftime('%Y-%m-%d', time.gmtime(end_date / 1000))}}
+    else:
+        section = {'totalAllowance': total, 'tokensUsed': used}
+    return {'usage': {shape: section, 'endDate': end_date}}
+
+
+class TokenBucket:
+    """每秒 rate 个令牌；取不到令牌时返回需要等待的秒数（作为 Retry-After）"""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class StubConfig:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 rate_limit=0.0, retry_after=1.0, shape='mixed'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.shape = shape
+        self.bucket = TokenBucket(rate_limit) if rate_limit > 0 else None
+        self.stats = {'requests': 0, '200': 0, '401': 0, '429': 0, '5xx': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+            self.stats['requests'] += 1
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config: StubConfig = None
+
+    def do_GET(self):
+        cfg = self.config
+        if self.path.split('?')[0] != API_PATH:
+            self._reply(404, {'error': 'not found'})
+            return
+        key = self.headers.get('Authorization', '').partition(' ')[2]
+        delay = cfg.latency + (random.uniform(0, cfg.jitter) if cfg.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        wait = cfg.bucket.take() if cfg.bucket else 0.0
+        if wait or (cfg.throttle_rate and random.random() < cfg.throttle_rate):
+            cfg.count('429')
+            self._reply(429, {'error': 'rate limited'}, {'Retry-After': f'{max(wait, cfg.retry_after):.2f}'})
+        elif cfg.error_rate and random.random() < cfg.error_rate:
+            cfg.count('5xx')
+            self._reply(random.choice((500, 502, 503)), {'error': 'upstream error'})
+        elif not key or key.startswith('bad'):
+            cfg.count('401')
+            self._reply(401, {'error': 'unauthorized'})
+        else:
+            cfg.count('200')
+            self._reply(200, usage_body(key, cfg.shape))
+
+    def _reply(self, status: int, data: dict, headers: dict = None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port: int = 0, **options):
+    """后台线程启动模拟服务，返回 (server, config)；port=0 时自动分配"""
+    config = StubConfig(**options)
+    handler = type('BoundStubHandler', (StubHandler,), {'config': config})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='upstream-stub', daemon=True).start()
+    return server, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local chat-usage upstream simulator')
+    parser.add_argument('--port', type=int, default=18999)
+    parser.add_argument('--latency', type=float, default=0.0, help='fixed latency per request (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra uniform random latency (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 5xx')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='requests/s before answering 429 (0 = unlimited)')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds on 429')
+    parser.add_argument('--shape', choices=SHAPES + ('mixed',), default='mixed')
+    args = parser.parse_args()
+    server, config = start_stub(args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+                                retry_after=args.retry_after, shape=args.shape)
+    print(f'chat-usage stub on http://127.0.0.1:{server.server_address[1]}{API_PATH}')
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(config.stats), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -180,7 +180,8 @@ function Derive-KeyAndIV {
     return @{ Key = $key; IV = $iv }
 }
 
-function Decrypt-Keys {
+# keys.enc 每行一条记录：key<TAB>id=...<TAB>label=...（见 serve.py）。整行原样读写，只在需要 key 时取第一个字段
+function Decrypt-KeyRecords {
     if (-not (Test-Path $script:KEYS_FILE) -or (Get-Item $script:KEYS_FILE).Length -eq 0) {
         return @()
     }
@@ -216,11 +217,9 @@ function Decrypt-Keys {
         $decrypted = $decryptor.TransformFinalBlock($ciphertext, 0, $ciphertext.Length)
         $text = [System.Text.Encoding]::UTF8.GetString($decrypted)
         
-        $keys = $text -split "`n" | Where-Object { $_.Trim() } | ForEach-Object {
-            ($_ -split "`t")[0]
-        }
+        $records = $text -split "`n" | ForEach-Object { $_.TrimEnd("`r") } | Where-Object { $_.Trim() }
         
-        return @($keys)
+        return @($records)
     }
     catch {
         return @()
@@ -230,6 +229,15 @@ function Decrypt-Keys {
     }
 }
 
+function Get-RecordKey {
+    param([string]$Record)
+    return ($Record -split "`t")[0]
+}
+
+function Decrypt-Keys {
+    return @(Decrypt-KeyRecords | ForEach-Object { Get-RecordKey -Record $_ })
+}
+
 function Encrypt-Keys {
     param([string[]]$Keys)
     
@@ -254,7 +262,8 @@ function Encrypt-Keys {
     $aes.Padding = [System.Security.Cryptography.PaddingMode]::PKCS7
     
     try {
-        $text = ($Keys | ForEach-Object { "$_`t" }) -join "`n"
+        # 已有记录整行写回；新加的裸 key 按旧格式补一个 TAB，由 serve.py 迁移时补上 id
+        $text = ($Keys | ForEach-Object { if ($_ -match "`t") { $_ } else { "$_`t" } }) -join "`n"
         $plainBytes = [System.Text.Encoding]::UTF8.GetBytes($text)
         
         $encryptor = $aes.CreateEncryptor()
@@ -515,7 +524,7 @@ function Cmd-Add {
     param([string[]]$AddArgs)
     
     Ensure-Store
-    $keys = @(Decrypt-Keys)
+    $keys = @(Decrypt-KeyRecords)
     
     $fileMode = $false
     $filePath = ""
@@ -823,7 +832,7 @@ function Cmd-Remove {
     }
     
     Ensure-Store
-    $keys = @(Decrypt-Keys)
+    $keys = @(Decrypt-KeyRecords)
     
     $toRemove = $RmArgs | ForEach-Object { [int]$_ }
     
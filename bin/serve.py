@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
+import asyncio
 import base64
+import bisect
 import concurrent.futures
 import hashlib
+import http.client
 import http.server
 import json
 import os
 import platform
 import secrets
+import struct
 import subprocess
 import sys
 import threading
-import urllib.request
-import urllib.error
 from urllib.parse import unquote, urlsplit, urlunsplit
 
 SALT = b"oroio"
@@ -20,6 +22,253 @@ PIN_HASH = None  # Will be set on startup
 ITERATIONS = 10000
 IS_WINDOWS = platform.system() == 'Windows'
 
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """进程内指标，按 Prometheus 文本格式导出。计数器与直方图以 (名称, 标签) 聚合"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._help = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def time(self, name: str, labels: dict = None):
+        """with METRICS.time('x_seconds'): ... 记录耗时"""
+        import contextlib
+        import time
+
+        @contextlib.contextmanager
+        def timer():
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(name, time.perf_counter() - started, labels)
+        return timer()
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        parts = []
+        for k, v in items:
+            v = str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            parts.append(f'{k}="{v}"')
+        return '{' + ','.join(parts) + '}'
+
+    @staticmethod
+    def _num(value) -> str:
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    def render(self, gauges: list = ()) -> str:
+        """gauges: [(name, labels dict, value)]，由调用方在导出时现算"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append(f'{name}{self._labels(labels)} {self._num(value)}')
+        for (name, labels), h in histograms.items():
+            lines = series.setdefault(name, [])
+            for bound, count in zip(LATENCY_BUCKETS, h):
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", f"{bound:g}")])} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {h[-1]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {h[-2]:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {h[-1]}')
+        for name, labels, value in gauges:
+            series.setdefault(name, []).append(f'{name}{self._labels(sorted(labels.items()))} {self._num(value)}')
+        out = []
+        for name in sorted(series):
+            if name in self._help:
+                kind, text = self._help[name]
+                out.append(f'# HELP {name} {text}')
+                out.append(f'# TYPE {name} {kind}')
+            out.extend(series[name])
+        return '\n'.join(out) + '\n'
+
+METRICS = Metrics()
+for _name, _kind, _text in (
+    ('oroio_http_requests_total', 'counter', 'HTTP requests by route, method and status'),
+    ('oroio_http_request_seconds', 'histogram', 'HTTP request latency by route'),
+    ('oroio_upstream_requests_total', 'counter', 'chat-usage API attempts by HTTP status (or error)'),
+    ('oroio_upstream_request_seconds', 'histogram', 'chat-usage API attempt latency'),
+    ('oroio_upstream_retries_total', 'counter', 'chat-usage API retries'),
+    ('oroio_refresh_coalesced_total', 'counter', 'Refreshes served by an in-flight or just-finished fetch, by level and reason'),
+    ('oroio_usage_fetch_total', 'counter', 'Per-key usage fetch outcomes by RAW status (ok on success)'),
+    ('oroio_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit/miss)'),
+    ('oroio_keys_decrypt_seconds', 'histogram', 'keys.enc decrypt latency by backend'),
+    ('oroio_keys_encrypt_seconds', 'histogram', 'keys.enc encrypt+write latency by backend'),
+    ('oroio_key_balance', 'gauge', 'Cached remaining balance per key'),
+    ('oroio_key_total', 'gauge', 'Cached total allowance per key'),
+    ('oroio_key_remaining_ratio', 'gauge', 'Cached remaining balance / total per key'),
+    ('oroio_key_usage_age_seconds', 'gauge', 'Age of the cached usage entry per key'),
+    ('oroio_keys', 'gauge', 'Number of keys in keys.enc'),
+    ('oroio_current_key_index', 'gauge', 'Current key index (1-based)'),
+    ('oroio_poll_last_timestamp_seconds', 'gauge', 'Unix time of the last completed background poll'),
+    ('oroio_sse_subscribers', 'gauge', 'Connected SSE clients'),
+    ('oroio_http_rejected_total', 'counter', 'Connections answered with 503 because the accept queue was full'),
+    ('oroio_http_queue_seconds', 'histogram', 'Time a connection waited in the accept queue for a worker'),
+    ('oroio_http_workers', 'gauge', 'Worker threads in the server pool'),
+    ('oroio_http_workers_busy', 'gauge', 'Worker threads currently handling a connection'),
+    ('oroio_http_queue_depth', 'gauge', 'Connections waiting for a worker'),
+    ('oroio_proxy_requests_total', 'counter', 'Proxied requests by final upstream status'),
+    ('oroio_proxy_failover_total', 'counter', 'Proxy key switches after upstream auth/quota errors, by reason'),
+    ('oroio_lease_grants_total', 'counter', 'Key leases granted by the coordinator'),
+    ('oroio_lease_restored_total', 'counter', 'Leases re-created on renew after expiry or a coordinator restart'),
+    ('oroio_lease_reclaimed_total', 'counter', 'Leases reclaimed because the client stopped renewing'),
+    ('oroio_leases_active', 'gauge', 'Active coordinator leases per key'),
+):
+    METRICS.describe(_name, _kind, _text)
+
+ACCESS_LOG = os.environ.get('DKM_ACCESS_LOG', '0') == '1'            # 每个请求写一行 JSON 访问日志
+SLOW_REQUEST_MS = float(os.environ.get('DKM_SLOW_MS', '2000'))        # 超过此耗时的请求记录调用栈采样（0 关闭）
+LOG_MAX_BYTES = int(os.environ.get('DKM_LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get('DKM_LOG_BACKUPS', '3'))
+SLOW_STACK_DEPTH = 24
+TRACING = ACCESS_LOG or SLOW_REQUEST_MS > 0
+
+class RequestTrace:
+    """单个请求的分阶段耗时；由处理线程通过 thread-local 访问"""
+    __slots__ = ('thread_id', 'started', 'phases', 'bytes', 'stack')
+
+    def __init__(self):
+        import time
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.bytes = 0
+        self.stack = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+_TRACE = threading.local()
+
+def current_trace():
+    return getattr(_TRACE, 'current', None)
+
+class _PhaseTimer:
+    """with trace_phase('decrypt'): ... 把耗时计入当前请求；不在请求线程中时几乎无开销"""
+    __slots__ = ('name', 'trace', 'started')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace = current_trace()
+
+    def __enter__(self):
+        if self.trace is not None:
+            import time
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            import time
+            self.trace.add(self.name, time.perf_counter() - self.started)
+        return False
+
+def trace_phase(name: str) -> _PhaseTimer:
+    return _PhaseTimer(name)
+
+class SlowRequestWatchdog:
+    """定期检查进行中的请求，超过阈值时对其线程采样一次调用栈（此刻卡在哪里）"""
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.interval = max(0.05, threshold / 4)
+        self._lock = threading.Lock()
+        self._active = set()
+        self._thread = None
+
+    def track(self, trace: RequestTrace):
+        with self._lock:
+            self._active.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='slow-request-watchdog', daemon=True)
+                self._thread.start()
+
+    def untrack(self, trace: RequestTrace):
+        with self._lock:
+            self._active.discard(trace)
+
+    def _loop(self):
+        import time
+        import traceback
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                due = [t for t in self._active if t.stack is None and now - t.started >= self.threshold]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for trace in due:
+                frame = frames.get(trace.thread_id)
+                if frame is not None:
+                    trace.stack = [line.rstrip() for line in traceback.format_stack(frame)[-SLOW_STACK_DEPTH:]]
+
+SLOW_WATCHDOG = SlowRequestWatchdog(SLOW_REQUEST_MS / 1000) if SLOW_REQUEST_MS > 0 else None
+
+class _TracedWriter:
+    """包装 handler.wfile，把响应写出计入 respond 阶段并统计字节数"""
+    def __init__(self, raw):
+        self._raw = raw
+
+    def write(self, data):
+        with trace_phase('respond') as timer:
+            n = self._raw.write(data)
+        if timer.trace is not None:
+            timer.trace.bytes += len(data)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+_access_logs = {}
+_access_logs_lock = threading.Lock()
+
+def get_access_log(oroio_dir: str):
+    """<oroio_dir>/logs/access.log，按大小轮转（DKM_LOG_MAX_BYTES × DKM_LOG_BACKUPS）"""
+    import logging
+    import logging.handlers
+    oroio_dir = os.path.abspath(oroio_dir)
+    with _access_logs_lock:
+        logger = _access_logs.get(oroio_dir)
+        if logger is None:
+            log_dir = os.path.join(oroio_dir, 'logs')
+            os.makedirs(log_dir, exist_ok=True)
+            logger = logging.getLogger(f'oroio.access.{len(_access_logs)}')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(log_dir, 'access.log'), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            _access_logs[oroio_dir] = logger
+        return logger
+
 def _derive_key_iv(salt: bytes) -> tuple:
     """PBKDF2-SHA256 派生 key(32) 和 iv(16)"""
     derived = hashlib.pbkdf2_hmac('sha256', SALT, salt, ITERATIONS, dklen=48)
@@ -67,144 +316,2331 @@ if IS_WINDOWS:
         def __del__(self):
             if self.hKey: bcrypt.BCryptDestroyKey(self.hKey)
             if self.hAlg: bcrypt.BCryptCloseAlgorithmProvider(self.hAlg, 0)
+else:
+    import ctypes
+    import ctypes.util
+
+    def _load_libcrypto():
+        """加载系统 libcrypto，找不到时返回 None（回退到 openssl 子进程）"""
+        if platform.system() == 'Darwin':
+            # macOS 直接加载 /usr/lib/libcrypto.dylib 会被系统 abort，只尝试 Homebrew 的带版本库
+            names = ['/opt/homebrew/opt/openssl@3/lib/libcrypto.3.dylib',
+                     '/usr/local/opt/openssl@3/lib/libcrypto.3.dylib']
+        else:
+            names = [ctypes.util.find_library('crypto'), 'libcrypto.so.3', 'libcrypto.so.1.1']
+        for name in names:
+            if not name:
+                continue
+            try:
+                lib = ctypes.CDLL(name)
+                lib.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+                lib.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+                lib.EVP_aes_256_cbc.restype = ctypes.c_void_p
+                lib.EVP_CipherInit_ex.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                                                  ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+                lib.EVP_CipherUpdate.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int),
+                                                 ctypes.c_char_p, ctypes.c_int]
+                lib.EVP_CipherFinal_ex.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int)]
+                return lib
+            except (OSError, AttributeError):
+                continue
+        return None
+
+    libcrypto = _load_libcrypto()
+
+    class AESCipher:
+        """AES-256-CBC (PKCS#7)，通过 libcrypto EVP 接口在进程内完成，接口与 Windows 版一致"""
+        def __init__(self, key: bytes, iv: bytes):
+            self.key = key
+            self.iv = iv
+
+        def _run(self, data: bytes, enc: int) -> bytes:
+            ctx = libcrypto.EVP_CIPHER_CTX_new()
+            if not ctx:
+                raise RuntimeError('EVP_CIPHER_CTX_new failed')
+            try:
+                if libcrypto.EVP_CipherInit_ex(ctx, libcrypto.EVP_aes_256_cbc(), None, self.key, self.iv, enc) != 1:
+                    raise RuntimeError('EVP_CipherInit_ex failed')
+                out = ctypes.create_string_buffer(len(data) + 32)
+                out_len = ctypes.c_int(0)
+                if libcrypto.EVP_CipherUpdate(ctx, out, ctypes.byref(out_len), data, len(data)) != 1:
+                    raise RuntimeError('EVP_CipherUpdate failed')
+                total = out_len.value
+                tail = ctypes.create_string_buffer(32)
+                if libcrypto.EVP_CipherFinal_ex(ctx, tail, ctypes.byref(out_len)) != 1:
+                    raise ValueError('bad decrypt')
+                return out.raw[:total] + tail.raw[:out_len.value]
+            finally:
+                libcrypto.EVP_CIPHER_CTX_free(ctx)
+
+        def decrypt(self, ciphertext: bytes) -> bytes:
+            return self._run(ciphertext, 0)
+
+        def encrypt(self, plaintext: bytes) -> bytes:
+            return self._run(plaintext, 1)
+
+HAS_INPROC_AES = IS_WINDOWS or libcrypto is not None
+
+# 解密结果缓存：以 keys.enc 的 (mtime_ns, size, inode) 为签名，文件未变则跳过读盘与解密
+_keys_cache_lock = threading.Lock()
+_keys_cache = {'sig': None, 'records': []}
+
+def _file_sig(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _decrypt_blob(data: bytes) -> str:
+    """解密 OpenSSL `Salted__` 格式数据"""
+    if len(data) < 17 or data[:8] != b'Salted__':
+        raise ValueError('invalid keys.enc format')
+    salt, ciphertext = data[8:16], data[16:]
+    key, iv = _derive_key_iv(salt)
+    return AESCipher(key, iv).decrypt(ciphertext).decode('utf-8')
+
+def _encrypt_blob(text: str) -> bytes:
+    """加密为 OpenSSL `Salted__` 格式（与 openssl enc -aes-256-cbc -pbkdf2 -salt 兼容）"""
+    salt = secrets.token_bytes(8)
+    key, iv = _derive_key_iv(salt)
+    return b'Salted__' + salt + AESCipher(key, iv).encrypt(text.encode('utf-8'))
+
+# keys.enc 每行一条记录：`key<TAB>id=...<TAB>label=...<TAB>added=...<TAB>tags=a,b`。
+# 旧格式为 `key<TAB>`；dk / dk.ps1 / web 只取第一个字段，因此新格式对它们透明。
+KEY_RECORD_FIELDS = ('id', 'label', 'added', 'tags')
+
+def _parse_key_line(line: str) -> dict:
+    from urllib.parse import unquote as unquote_value
+    fields = line.split('\t')
+    record = {'key': fields[0].strip(), 'id': None, 'label': '', 'addedAt': None, 'tags': [], 'extra': []}
+    for field in fields[1:]:
+        name, sep, value = field.partition('=')
+        if not sep or name not in KEY_RECORD_FIELDS:
+            if field:
+                record['extra'].append(field)  # 未知字段原样保留
+            continue
+        value = unquote_value(value)
+        if name == 'id':
+            record['id'] = value or None
+        elif name == 'label':
+            record['label'] = value
+        elif name == 'added':
+            record['addedAt'] = int(value) if value.isdigit() else None
+        elif name == 'tags':
+            record['tags'] = [t for t in value.split(',') if t]
+    return record
+
+def _format_key_line(record: dict) -> str:
+    from urllib.parse import quote
+    fields = [record['key'], f"id={record['id']}"]
+    if record.get('label'):
+        fields.append('label=' + quote(record['label'], safe=' '))
+    if record.get('addedAt'):
+        fields.append(f"added={int(record['addedAt'])}")
+    if record.get('tags'):
+        fields.append('tags=' + ','.join(quote(t, safe='') for t in record['tags']))
+    fields.extend(record.get('extra', []))
+    return '\t'.join(fields)
+
+def key_id(keys_file: str, key: str) -> str:
+    """key 的稳定 ID：与用量缓存使用同一 HMAC 指纹，因此即使其他写入方丢掉了 id 字段，重新推导的结果也相同"""
+    return get_usage_cache(os.path.dirname(keys_file)).fingerprint(key)
+
+def _read_key_records(keys_file: str) -> list:
+    if HAS_INPROC_AES:
+        with open(keys_file, 'rb') as f:
+            data = f.read()
+        if len(data) < 17 or data[:8] != b'Salted__':
+            return []
+        text = _decrypt_blob(data)
+    else:
+        result = subprocess.run(
+            ['openssl', 'enc', '-d', '-aes-256-cbc', '-pbkdf2', '-in', keys_file, '-pass', f'pass:{SALT.decode()}'],
+            capture_output=True
+        )
+        if result.returncode != 0:
+            return []
+        text = result.stdout.decode('utf-8')
+    records = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line:
+            record = _parse_key_line(line)
+            if record['id'] is None:
+                record['id'] = key_id(keys_file, record['key'])
+                record['legacy'] = True
+            records.append(record)
+    return records
+
+def _copy_record(record: dict) -> dict:
+    return {**record, 'tags': list(record['tags']), 'extra': list(record['extra'])}
+
+def _cached_key_records(keys_file: str) -> list:
+    # 返回缓存中的记录本身，调用方不得修改
+    sig = _file_sig(keys_file)
+    if sig is None:
+        return []
+    with _keys_cache_lock:
+        if _keys_cache['sig'] == sig:
+            METRICS.inc('oroio_cache_requests_total', {'cache': 'keys', 'result': 'hit'})
+            return _keys_cache['records']
+    METRICS.inc('oroio_cache_requests_total', {'cache': 'keys', 'result': 'miss'})
+    try:
+        with trace_phase('decrypt'), METRICS.time('oroio_keys_decrypt_seconds', {'backend': 'inproc' if HAS_INPROC_AES else 'openssl'}):
+            records = _read_key_records(keys_file)
+    except Exception:
+        return []
+    with _keys_cache_lock:
+        _keys_cache['sig'] = sig
+        _keys_cache['records'] = records
+    return records
+
+def read_key_records(keys_file: str) -> list:
+    """解密 keys.enc，返回记录列表（key/id/label/addedAt/tags）"""
+    return [_copy_record(r) for r in _cached_key_records(keys_file)]
+
+def decrypt_keys(keys_file: str) -> list:
+    """解密 keys.enc 文件，返回 key 列表"""
+    return [r['key'] for r in _cached_key_records(keys_file)]
+
+def key_record_info(record: dict, index: int) -> dict:
+    """对外暴露的记录信息（不含 key 明文）"""
+    return {'index': index, 'id': record['id'], 'label': record.get('label', ''),
+            'addedAt': record.get('addedAt'), 'tags': record.get('tags', [])}
+
+# 串行化 keys.enc 的读-改-写
+KEYS_WRITE_LOCK = threading.Lock()
+
+def write_key_records(records: list, keys_file: str):
+    """加密记录列表并写入文件"""
+    for record in records:
+        record.pop('legacy', None)
+    text = '\n'.join(_format_key_line(r) for r in records)
+    with trace_phase('disk_write'), METRICS.time('oroio_keys_encrypt_seconds', {'backend': 'inproc' if HAS_INPROC_AES else 'openssl'}):
+        if HAS_INPROC_AES:
+            tmp_file = f'{keys_file}.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(_encrypt_blob(text))
+            os.replace(tmp_file, keys_file)
+        else:
+            subprocess.run(
+                ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-salt', '-out', keys_file, '-pass', f'pass:{SALT.decode()}'],
+                input=text.encode('utf-8'),
+                check=True
+            )
+    sig = _file_sig(keys_file)
+    with _keys_cache_lock:
+        _keys_cache['sig'] = sig
+        _keys_cache['records'] = [_copy_record(r) for r in records] if sig else []
+
+def new_key_record(keys_file: str, key: str, label: str = '', tags: list = None) -> dict:
+    import time
+    return {'key': key, 'id': key_id(keys_file, key), 'label': label, 'addedAt': int(time.time()),
+            'tags': list(tags or []), 'extra': []}
+
+def encrypt_keys(keys: list, keys_file: str):
+    """加密 key 列表并写入文件；已有 key 沿用原记录（ID 与元数据），新 key 生成新记录"""
+    existing = {r['key']: r for r in read_key_records(keys_file)}
+    write_key_records([existing.get(k) or new_key_record(keys_file, k) for k in keys], keys_file)
+
+def migrate_key_records(keys_file: str) -> bool:
+    """把旧格式（`key<TAB>`）的条目补上 id 等字段后写回，返回是否发生迁移"""
+    with KEYS_WRITE_LOCK:
+        records = read_key_records(keys_file)
+        if not any(r.get('legacy') for r in records):
+            return False
+        for record in records:
+            if record.get('legacy') and not record.get('addedAt'):
+                record['addedAt'] = int(os.stat(keys_file).st_mtime)
+        write_key_records(records, keys_file)
+        return True
+
+def find_key_record(records: list, key_id_: str = None, index=None):
+    """按 id 或 1 起始的序号定位记录，返回 (序号, 记录)；找不到返回 (None, None)"""
+    if key_id_:
+        for i, record in enumerate(records, 1):
+            if record['id'] == key_id_:
+                return i, record
+        return None, None
+    try:
+        idx = int(index)
+    except (TypeError, ValueError):
+        return None, None
+    if 1 <= idx <= len(records):
+        return idx, records[idx - 1]
+    return None, None
+
+API_BASE_URL = os.environ.get('DKM_API_BASE', 'https://app.factory.ai')
+API_PATH = '/api/organization/members/chat-usage'
+API_URL = API_BASE_URL.rstrip('/') + API_PATH
+API_TIMEOUT = 8
+API_RETRIES = 3
+API_POOL_IDLE = float(os.environ.get('DKM_API_POOL_IDLE', '30'))      # 空闲连接保留秒数
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}      # 连接中途断开时可安全重发的方法
+API_BACKOFF_BASE = 0.25                                              # 重试退避基数（秒），按 2^n 增长并加抖动
+API_BACKOFF_CAP = 8.0
+REFRESH_INITIAL_CONCURRENCY = int(os.environ.get('DKM_REFRESH_INITIAL_CONCURRENCY', '6'))  # 慢启动的初始并发
+REFRESH_MIN_CONCURRENCY = int(os.environ.get('DKM_REFRESH_MIN_CONCURRENCY', '2'))
+REFRESH_MAX_CONCURRENCY = int(os.environ.get('DKM_REFRESH_MAX_CONCURRENCY', '32'))
+REFRESH_DEBOUNCE = float(os.environ.get('DKM_REFRESH_DEBOUNCE', '2'))  # 距上一轮手动刷新完成不足此秒数的刷新请求直接复用其结果
+API_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+FACTORY_DIR = os.path.join(os.path.expanduser('~'), '.factory')
+
+class HTTPPool:
+    """Keep-alive 连接池，跨线程共享，避免每个请求都重新 TCP/TLS 握手（key 代理转发上游时使用；
+    用量查询统一走 AsyncUsageRefresher）"""
+    def __init__(self, base_url: str, size: int, idle_timeout: float = API_POOL_IDLE, timeout: float = API_TIMEOUT):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Unsupported base URL: {base_url}')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.size = max(1, size)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []  # [(conn, last_used)]
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _connect(self):
+        if self.scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        """取一个未过期的空闲连接，返回 (conn, reused)"""
+        import time
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def _release(self, conn):
+        import time
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def open(self, method: str, path: str, headers: dict = None, body: bytes = None) -> tuple:
+        """流式请求：返回 (conn, resp)，由调用方读取响应体后交给 done()，适合长时间的流式响应"""
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, self.prefix + path, body=body, headers=headers or {})
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    BrokenPipeError, ConnectionResetError) as e:
+                conn.close()
+                # 复用的空闲连接可能已被上游关闭：未收到任何响应字节时（RemoteDisconnected/BadStatusLine）换新连接重发；
+                # 发送中途被 reset 时上游可能已收到请求，只重发幂等方法，避免 POST 被执行两次
+                if reused and (isinstance(e, (http.client.RemoteDisconnected, http.client.BadStatusLine))
+                               or method in IDEMPOTENT_METHODS):
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+    def done(self, conn, resp):
+        """响应体已读完且连接可复用时放回池中，否则关闭"""
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+        else:
+            self._release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+def parse_usage(data: dict, result: dict) -> dict:
+    """把 chat-usage 响应解析到 result（BALANCE/TOTAL/USED/EXPIRES/RAW）"""
+    usage = data.get('usage')
+    if not usage:
+        result['RAW'] = 'no_usage'
+        return result
+    section = usage.get('standard') or usage.get('premium') or usage.get('total') or usage.get('main')
+    if section:
+        total = section.get('totalAllowance') or section.get('basicAllowance') or section.get('allowance')
+        used = section.get('orgTotalTokensUsed') or section.get('used') or section.get('tokensUsed') or 0
+        used += section.get('orgOverageUsed') or 0
+        if total is not None:
+            result['TOTAL'] = int(total)
+            result['USED'] = int(used)
+            result['BALANCE_NUM'] = int(total - used)
+            result['BALANCE'] = result['BALANCE_NUM']
+    exp_raw = usage.get('endDate') or usage.get('expire_at') or usage.get('expires_at')
+    if exp_raw is not None:
+        if isinstance(exp_raw, (int, float)) or (isinstance(exp_raw, str) and exp_raw.isdigit()):
+            from datetime import datetime
+            result['EXPIRES'] = datetime.utcfromtimestamp(int(exp_raw) / 1000).strftime('%Y-%m-%d')
+        else:
+            result['EXPIRES'] = str(exp_raw)
+    return result
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """指数退避 + 抖动；服务端给出 Retry-After 时以其为下限"""
+    import random
+    delay = min(API_BACKOFF_CAP, API_BACKOFF_BASE * (2 ** attempt))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, API_BACKOFF_CAP))
+    return delay
+
+def _count_fetch(result: dict) -> dict:
+    METRICS.inc('oroio_usage_fetch_total', {'raw': result.get('RAW') or 'ok'})
+    return result
+
+class AIMDLimiter:
+    """自适应并发上限：慢启动 + AIMD。成功时增加，429/5xx/超时/延迟陡增时减半"""
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.ssthresh = float(self.maximum)
+        self.in_flight = 0
+        self.min_latency = None
+        self._last_decrease = 0.0
+        self._cond = None
+
+    async def acquire(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency: float):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        # 延迟远高于基线说明上游在排队，视同拥塞
+        if latency > 0.5 and latency > self.min_latency * 4:
+            self.on_congestion()
+            return
+        if self.limit < self.ssthresh:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_congestion(self):
+        import time
+        now = time.monotonic()
+        # 同一轮窗口内只减一次，避免一批同时失败的请求把并发压到底
+        if now - self._last_decrease < max(0.5, (self.min_latency or 0) * 2):
+            return
+        self._last_decrease = now
+        self.ssthresh = max(self.minimum, self.limit / 2)
+        self.limit = self.ssthresh
+
+class AsyncUsageRefresher:
+    """基于 asyncio 的批量用量刷新引擎，自带 HTTP/1.1 keep-alive 连接管理"""
+    def __init__(self, base_url: str = API_BASE_URL, min_concurrency: int = REFRESH_MIN_CONCURRENCY,
+                 max_concurrency: int = REFRESH_MAX_CONCURRENCY, deadline: float = API_TIMEOUT,
+                 retries: int = API_RETRIES, idle_timeout: float = API_POOL_IDLE):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Unsupported base URL: {base_url}')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.prefix = parts.path.rstrip('/')
+        self.host_header = parts.netloc
+        self.deadline = deadline
+        self.retries = max(1, retries)
+        self.idle_timeout = idle_timeout
+        self.limiter = AIMDLimiter(REFRESH_INITIAL_CONCURRENCY, min_concurrency, max_concurrency)
+        self._idle = []  # [(reader, writer, last_used)]
+        self._inflight = {}  # key -> Task
+        self._ssl_context = None
+
+    async def _open(self):
+        ssl_context = None
+        if self.scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return await asyncio.open_connection(self.host, self.port, ssl=ssl_context,
+                                             server_hostname=self.host if ssl_context else None)
+
+    async def _acquire(self):
+        import time
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if now - last_used <= self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._open()
+        return reader, writer, False
+
+    def _release(self, reader, writer):
+        import time
+        if len(self._idle) < self.limiter.maximum:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _read_body(self, reader, headers: dict) -> tuple:
+        """按 Content-Length / chunked / 读到 EOF 三种方式读取响应体，返回 (body, keep_alive)"""
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            return b''.join(chunks), True
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length'])), True
+        return await reader.read(), False
+
+    async def _get(self, key: str) -> tuple:
+        """发送一次 GET，返回 (status, headers, body)。复用连接被对端关闭时换新连接重试一次"""
+        request = (
+            f'GET {self.prefix}{API_PATH} HTTP/1.1\r\n'
+            f'Host: {self.host_header}\r\n'
+            f'Authorization: Bearer {key}\r\n'
+            f'User-Agent: {API_USER_AGENT}\r\n'
+            'Accept: application/json\r\n'
+            'Connection: keep-alive\r\n\r\n'
+        ).encode('latin-1')
+        while True:
+            reader, writer, reused = await self._acquire()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('connection closed by peer')
+                status = int(status_line.split()[1])
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body, keep_alive = await self._read_body(reader, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive and headers.get('connection', '').lower() != 'close':
+                self._release(reader, writer)
+            else:
+                writer.close()
+            return status, headers, body
+
+    async def fetch(self, key: str) -> dict:
+        """获取单个 key 的用量；同一 key 已有进行中的请求时直接共享其结果（single-flight）"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch(key))
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        else:
+            METRICS.inc('oroio_refresh_coalesced_total', {'level': 'key', 'reason': 'inflight'})
+        # shield：某个调用方被取消时不影响共享同一请求的其他调用方
+        return dict(await asyncio.shield(task))
+
+    async def _fetch(self, key: str) -> dict:
+        """429/5xx/超时按抖动指数退避重试，并反馈给并发控制"""
+        import time
+        result = {'BALANCE': 0, 'BALANCE_NUM': 0, 'TOTAL': 0, 'USED': 0, 'EXPIRES': '?', 'RAW': ''}
+        last_status = None
+        for attempt in range(self.retries):
+            retry_after = None
+            await self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                status, headers, body = await asyncio.wait_for(self._get(key), self.deadline)
+            except Exception:
+                status, headers, body = None, {}, b''
+                self.limiter.on_congestion()
+            finally:
+                await self.limiter.release()
+            latency = time.monotonic() - started
+            METRICS.observe('oroio_upstream_request_seconds', latency)
+            METRICS.inc('oroio_upstream_requests_total', {'status': str(status) if status else 'error'})
+            if status == 200:
+                self.limiter.on_success(latency)
+                try:
+                    return _count_fetch(parse_usage(json.loads(body.decode('utf-8')), result))
+                except Exception:
+                    last_status = None
+            elif status is not None and (status == 429 or status >= 500):
+                self.limiter.on_congestion()
+                last_status = status
+                try:
+                    retry_after = float(headers.get('retry-after', ''))
+                except ValueError:
+                    pass
+            elif status is not None:
+                # 其他 4xx 是确定的答复（key 无效等），不重试
+                self.limiter.on_success(latency)
+                result['RAW'] = f'http_{status}'
+                result['EXPIRES'] = 'Invalid key'
+                return _count_fetch(result)
+            if attempt < self.retries - 1:
+                METRICS.inc('oroio_upstream_retries_total')
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+        result['RAW'] = f'http_{last_status}' if last_status else 'http_error'
+        result['EXPIRES'] = 'Invalid key'
+        return _count_fetch(result)
+
+    async def fetch_all(self, keys: list) -> list:
+        return list(await asyncio.gather(*(self.fetch(k) for k in keys)))
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer, _ in idle:
+            writer.close()
+
+_refresh_loop = None
+_refresh_engine = None
+_refresh_loop_lock = threading.Lock()
+
+def _refresh_runtime() -> tuple:
+    global _refresh_loop, _refresh_engine
+    with _refresh_loop_lock:
+        if _refresh_loop is None:
+            _refresh_loop = asyncio.new_event_loop()
+            threading.Thread(target=_refresh_loop.run_forever, name='usage-refresh', daemon=True).start()
+            _refresh_engine = AsyncUsageRefresher()
+    return _refresh_loop, _refresh_engine
+
+def refresh_usages(keys: list) -> list:
+    """在常驻的后台事件循环上运行异步刷新引擎，连接与并发状态在多次刷新之间保留"""
+    if not keys:
+        return []
+    loop, engine = _refresh_runtime()
+    with trace_phase('upstream'):
+        return asyncio.run_coroutine_threadsafe(engine.fetch_all(keys), loop).result()
+
+def iter_usages(keys: list):
+    """与 refresh_usages 相同，但按完成顺序逐个产出 (序号, usage)，用于流式进度"""
+    if not keys:
+        return
+    loop, engine = _refresh_runtime()
+    futures = {asyncio.run_coroutine_threadsafe(engine.fetch(k), loop): i for i, k in enumerate(keys)}
+    completed = concurrent.futures.as_completed(futures)
+    while True:
+        # 只把等待上游的时间计入 upstream，调用方处理每一项的时间不算
+        with trace_phase('upstream'):
+            future = next(completed, None)
+        if future is None:
+            return
+        yield futures[future], future.result()
+
+def encode_usage_info(u: dict) -> str:
+    """把单个 key 的用量编码成缓存行使用的 base64 文本（KEY=VALUE 每行一项）"""
+    info = '\n'.join([
+        f"BALANCE={u.get('BALANCE', 0)}",
+        f"BALANCE_NUM={u.get('BALANCE_NUM', 0)}",
+        f"TOTAL={u.get('TOTAL', 0)}",
+        f"USED={u.get('USED', 0)}",
+        f"EXPIRES={u.get('EXPIRES', '?')}",
+        f"RAW={u.get('RAW', '')}"
+    ])
+    return base64.b64encode(info.encode('utf-8')).decode('ascii')
+
+def decode_usage_info(b64: str) -> dict:
+    """encode_usage_info 的逆操作"""
+    usage = {'BALANCE': 0, 'BALANCE_NUM': 0, 'TOTAL': 0, 'USED': 0, 'EXPIRES': '?', 'RAW': ''}
+    for line in base64.b64decode(b64).decode('utf-8').split('\n'):
+        k, sep, v = line.partition('=')
+        if not sep or k not in usage:
+            continue
+        if k in ('BALANCE', 'BALANCE_NUM', 'TOTAL', 'USED'):
+            try:
+                usage[k] = int(float(v)) if v else 0
+            except ValueError:
+                usage[k] = 0
+        else:
+            usage[k] = v
+    return usage
+
+def write_cache(keys_file: str, cache_file: str, keys: list, usages: list, ts: int = None):
+    """写入缓存文件，格式与 dk/dk.ps1 兼容；usages 中为 None 的项不写出"""
+    import time
+    now = int(time.time()) if ts is None else int(ts)
+    keys_hash = hashlib.sha1(open(keys_file, 'rb').read()).hexdigest()
+    lines = [str(now), keys_hash]
+    for i, u in enumerate(usages):
+        if u is not None:
+            lines.append(f"{i}\t{encode_usage_info(u)}")
+    tmp_file = f'{cache_file}.tmp'
+    with trace_phase('disk_write'):
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines))
+        os.replace(tmp_file, cache_file)
+
+BURN_WINDOW = 6 * 3600   # 燃烧速率估算窗口（秒）
+BURN_SAMPLES = 24        # 每个 key 最多保留的采样点
+USAGE_TTL = int(os.environ.get('DKM_USAGE_TTL', '60'))                      # 正常使用中的 key
+USAGE_TTL_EXHAUSTED = int(os.environ.get('DKM_USAGE_TTL_EXHAUSTED', '3600'))  # 余额耗尽 / 无效 key
+USAGE_TTL_ERROR = int(os.environ.get('DKM_USAGE_TTL_ERROR', '15'))          # 网络错误、429、5xx
+
+def usage_ttl(usage: dict) -> int:
+    """根据用量状态决定缓存条目的 TTL：耗尽或无效的 key 很少变化，可以缓存更久"""
+    raw = usage.get('RAW', '')
+    if raw == 'http_error' or raw == 'http_429' or raw.startswith('http_5'):
+        return USAGE_TTL_ERROR
+    if raw.startswith('http_') or raw == 'no_usage':
+        return USAGE_TTL_EXHAUSTED
+    if usage.get('TOTAL', 0) > 0 and usage.get('BALANCE_NUM', 0) <= 0:
+        return USAGE_TTL_EXHAUSTED
+    return USAGE_TTL
+
+class UsageCache:
+    """按 key 指纹（截断的 HMAC）保存的用量缓存，每条记录有独立的获取时间与 TTL。
+    持久化到 usage_cache.json，并导出兼容 dk/dk.ps1 的 list_cache.b64。"""
+    def __init__(self, oroio_dir: str):
+        self.oroio_dir = oroio_dir
+        self.path = os.path.join(oroio_dir, 'usage_cache.json')
+        self.secret_file = os.path.join(oroio_dir, 'cache.secret')
+        self._lock = threading.RLock()
+        self._export_lock = threading.Lock()  # 串行化 list_cache.b64 的写出（共用同一个临时文件）
+        self._entries = None  # fp -> {'ts', 'ttl', 'usage'}
+        self._secret = None
+        self._legacy = (None, b'')  # ((keys.enc 签名, list_cache.b64 签名), 最近一次导出的内容)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self._entries = json.load(f).get('entries', {})
+        except Exception:
+            self._entries = {}
+
+    def _get_secret(self) -> bytes:
+        if self._secret is None:
+            try:
+                with open(self.secret_file, 'rb') as f:
+                    self._secret = f.read()
+            except OSError:
+                self._secret = b''
+            if len(self._secret) < 16:
+                self._secret = secrets.token_bytes(32)
+                fd = os.open(self.secret_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self._secret)
+        return self._secret
+
+    def fingerprint(self, key: str) -> str:
+        import hmac
+        return hmac.new(self._get_secret(), key.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def get(self, key: str):
+        with self._lock:
+            self._load()
+            entry = self._entries.get(self.fingerprint(key))
+            return dict(entry['usage']) if entry else None
+
+    def entry(self, key: str):
+        """返回 {'ts', 'ttl', 'usage', 'samples'} 副本，不存在时返回 None"""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(self.fingerprint(key))
+            if not entry:
+                return None
+            return {**entry, 'usage': dict(entry['usage']), 'samples': list(entry.get('samples', []))}
+
+    def put(self, key: str, usage: dict, ts: float = None):
+        import time
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            self._load()
+            fp = self.fingerprint(key)
+            prev = self._entries.get(fp)
+            samples = list(prev.get('samples', [])) if prev else []
+            # 记录 USED 的短时间序列，用于估算燃烧速率
+            if usage.get('TOTAL', 0) > 0 and not usage.get('RAW') and (not samples or ts > samples[-1][0]):
+                if samples and usage.get('USED', 0) < samples[-1][1]:
+                    samples = []  # 额度被重置
+                samples.append([ts, usage.get('USED', 0)])
+                samples = [x for x in samples if ts - x[0] <= BURN_WINDOW][-BURN_SAMPLES:]
+            self._entries[fp] = {
+                'ts': ts,
+                'ttl': usage_ttl(usage),
+                'usage': dict(usage),
+                'samples': samples,
+            }
+
+    def stale_keys(self, keys: list, now: float = None) -> list:
+        """返回缺失或已过期、需要重新获取的 key"""
+        import time
+        now = time.time() if now is None else now
+        with self._lock:
+            self._load()
+            stale = []
+            for key in keys:
+                entry = self._entries.get(self.fingerprint(key))
+                if entry is None or now - entry['ts'] >= entry['ttl']:
+                    stale.append(key)
+            return stale
+
+    def prune(self, keys: list):
+        """丢弃已不在 keys.enc 中的 key 的条目"""
+        with self._lock:
+            self._load()
+            live = {self.fingerprint(k) for k in keys}
+            for fp in [fp for fp in self._entries if fp not in live]:
+                del self._entries[fp]
+
+    def import_legacy(self, keys_file: str, cache_file: str, keys: list):
+        """把 dk/dk.ps1 写入的 list_cache.b64 中比本地更新的条目合并进来"""
+        try:
+            with open(cache_file, 'r') as f:
+                lines = f.read().split('\n')
+            if len(lines) < 3:
+                return
+            ts = int(lines[0])
+            if lines[1] != hashlib.sha1(open(keys_file, 'rb').read()).hexdigest():
+                return
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._load()
+            for line in lines[2:]:
+                idx, sep, b64 = line.partition('\t')
+                if not sep:
+                    continue
+                try:
+                    key = keys[int(idx)]
+                    entry = self._entries.get(self.fingerprint(key))
+                    if entry is None or entry['ts'] < ts:
+                        self.put(key, decode_usage_info(b64), ts)
+                except (IndexError, ValueError):
+                    continue
+
+    def save(self):
+        with self._lock:
+            self._load()
+            data = json.dumps({'version': 1, 'entries': self._entries})
+            tmp_file = f'{self.path}.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(data)
+            os.replace(tmp_file, self.path)
+
+    def export_legacy(self, keys_file: str, cache_file: str, keys: list):
+        """按 keys.enc 当前顺序导出 list_cache.b64；时间戳取最旧条目，保证 dk 的 TTL 判断仍然准确"""
+        with self._export_lock:
+            with self._lock:
+                self._load()
+                usages, oldest = [], None
+                for key in keys:
+                    entry = self._entries.get(self.fingerprint(key))
+                    usages.append(entry['usage'] if entry else None)
+                    if entry and (oldest is None or entry['ts'] < oldest):
+                        oldest = entry['ts']
+            write_cache(keys_file, cache_file, keys, usages, ts=oldest)
+            with open(cache_file, 'rb') as f:
+                body = f.read()
+            with self._lock:
+                self._legacy = ((_file_sig(keys_file), _file_sig(cache_file)), body)
+
+    def legacy_body(self, keys_file: str, cache_file: str):
+        """最近导出的 list_cache.b64 内容；keys.enc 或缓存文件此后被 dk 改动过则返回 None"""
+        with self._lock:
+            sig, body = self._legacy
+        if sig is None or sig != (_file_sig(keys_file), _file_sig(cache_file)):
+            return None
+        return body
+
+_usage_caches = {}
+_usage_caches_lock = threading.Lock()
+
+def get_usage_cache(oroio_dir: str) -> UsageCache:
+    oroio_dir = os.path.normpath(oroio_dir)
+    with _usage_caches_lock:
+        cache = _usage_caches.get(oroio_dir)
+        if cache is None:
+            cache = _usage_caches[oroio_dir] = UsageCache(oroio_dir)
+        return cache
+
+HISTORY_RAW_RETENTION = 2 * 86400       # 原始采样保留时长，之后汇总为小时桶
+HISTORY_HOURLY_RETENTION = 30 * 86400   # 小时桶保留时长，之后汇总为日桶
+HISTORY_COMPACT_INTERVAL = 3600
+
+class UsageHistory:
+    """追加写的定长二进制用量历史：(timestamp u32, key 指纹 8 字节, used i64, total i64)。
+    分 raw / hourly / daily 三层文件，各层内按时间有序，通过 mmap + 二分查找做区间查询。"""
+    MAGIC = b'OROHIST1'
+    RECORD = struct.Struct('<I8sqq')
+    TIERS = (('daily', 86400), ('hourly', 3600), ('raw', 0))
+
+    def __init__(self, oroio_dir: str):
+        self.dir = os.path.join(oroio_dir, 'history')
+        self._lock = threading.Lock()
+        self._last_compact = 0.0
+
+    def _path(self, tier: str) -> str:
+        return os.path.join(self.dir, f'{tier}.bin')
+
+    def _write_records(self, tier: str, records: list, append: bool = True):
+        os.makedirs(self.dir, exist_ok=True)
+        path = self._path(tier)
+        data = b''.join(self.RECORD.pack(int(ts), bytes.fromhex(kid), int(used), int(total))
+                        for ts, kid, used, total in records)
+        if append:
+            new = not os.path.exists(path) or os.path.getsize(path) < len(self.MAGIC)
+            with open(path, 'ab') as f:
+                if new:
+                    f.truncate(0)
+                    f.write(self.MAGIC)
+                f.write(data)
+        else:
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.MAGIC + data)
+            os.replace(tmp_path, path)
+
+    def _read_range(self, tier: str, start: float, end: float, key_ids=None) -> list:
+        """mmap 读取 [start, end) 内的记录；末尾不完整的记录（写入中断）会被忽略"""
+        import mmap
+        path = self._path(tier)
+        size = self.RECORD.size
+        try:
+            with open(path, 'rb') as f:
+                length = os.fstat(f.fileno()).st_size
+                count = (length - len(self.MAGIC)) // size
+                if count <= 0:
+                    return []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm[:len(self.MAGIC)] != self.MAGIC:
+                        return []
+                    base = len(self.MAGIC)
+                    ts_at = lambda i: struct.unpack_from('<I', mm, base + i * size)[0]
+
+                    def bisect(bound):
+                        lo, hi = 0, count
+                        while lo < hi:
+                            mid = (lo + hi) // 2
+                            if ts_at(mid) < bound:
+                                lo = mid + 1
+                            else:
+                                hi = mid
+                        return lo
+
+                    lo, hi = bisect(start), bisect(end)
+                    chunk = mm[base + lo * size:base + hi * size]
+            wanted = None if key_ids is None else {bytes.fromhex(k) for k in key_ids}
+            names = {}
+            out = []
+            for ts, kid, used, total in self.RECORD.iter_unpack(chunk):
+                if wanted is not None and kid not in wanted:
+                    continue
+                name = names.get(kid)
+                if name is None:
+                    name = names[kid] = kid.hex()
+                out.append((ts, name, used, total))
+            return out
+        except (OSError, ValueError):
+            return []
+
+    def append(self, samples: list):
+        """追加 (ts, key 指纹, used, total) 采样，并按需做一次汇总压缩"""
+        import time
+        with self._lock:
+            self._write_records('raw', sorted(samples))
+            if time.time() - self._last_compact >= HISTORY_COMPACT_INTERVAL:
+                self._compact_locked(time.time())
+
+    def query(self, start: float, end: float, key_ids=None) -> list:
+        """返回 [start, end) 内的记录，按时间排序；较早的区间来自小时/日汇总"""
+        with self._lock:
+            out = []
+            for tier, _ in self.TIERS:
+                out.extend(self._read_range(tier, start, end, key_ids))
+            return out
+
+    def compact(self, now: float = None):
+        import time
+        with self._lock:
+            self._compact_locked(time.time() if now is None else now)
+
+    def _rollup(self, src: str, dst: str, bucket: int, cutoff: float):
+        """把 src 中早于 cutoff 的记录按 (桶, key) 取最后一个值写入 dst，src 只保留剩余部分"""
+        old = self._read_range(src, 0, cutoff)
+        if not old:
+            return
+        buckets = {}
+        for ts, kid, used, total in old:
+            buckets[(ts - ts % bucket, kid)] = (used, total)
+        rolled = sorted((ts, kid, used, total) for (ts, kid), (used, total) in buckets.items())
+        self._write_records(dst, rolled)
+        self._write_records(src, self._read_range(src, cutoff, 2 ** 32), append=False)
+
+    def _compact_locked(self, now: float):
+        # 截止点对齐到桶边界，保证汇总后各层文件仍按时间有序
+        self._rollup('raw', 'hourly', 3600, (now - HISTORY_RAW_RETENTION) // 3600 * 3600)
+        self._rollup('hourly', 'daily', 86400, (now - HISTORY_HOURLY_RETENTION) // 86400 * 86400)
+        self._last_compact = now
+
+_usage_histories = {}
+_usage_histories_lock = threading.Lock()
+
+def get_usage_history(oroio_dir: str) -> UsageHistory:
+    with _usage_histories_lock:
+        history = _usage_histories.get(oroio_dir)
+        if history is None:
+            history = _usage_histories[oroio_dir] = UsageHistory(oroio_dir)
+        return history
+
+ROTATE_AHEAD_HOURS = float(os.environ.get('DKM_ROTATE_AHEAD_HOURS', '1'))  # 预计可用时间低于此值即提前轮换
+
+def burn_rate(samples: list):
+    """根据 [ts, used] 采样估算 tokens/小时；样本不足或跨度太短时返回 None"""
+    if len(samples) < 2:
+        return None
+    (t0, u0), (t1, u1) = samples[0], samples[-1]
+    if t1 - t0 < 60:
+        return None
+    return max(0, u1 - u0) / ((t1 - t0) / 3600)
+
+def _expires_ts(expires: str):
+    from datetime import datetime, timezone
+    try:
+        return datetime.strptime(str(expires)[:10], '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def assess_key(entry, now: float) -> dict:
+    """单个 key 的可用性、燃烧速率与预计剩余时间（小时）"""
+    info = {'usable': False, 'balance': None, 'total': None, 'burnRate': None,
+            'hoursLeft': None, 'hoursToExpiry': None, 'runway': None}
+    if entry is None:
+        return info
+    usage = entry['usage']
+    total, balance = usage.get('TOTAL', 0), usage.get('BALANCE_NUM', 0)
+    info.update(balance=balance, total=total)
+    exp_ts = _expires_ts(usage.get('EXPIRES', ''))
+    if exp_ts is not None:
+        info['hoursToExpiry'] = (exp_ts - now) / 3600
+    rate = burn_rate(entry.get('samples', []))
+    info['burnRate'] = rate
+    if rate:
+        info['hoursLeft'] = balance / rate
+    info['usable'] = (not usage.get('RAW') and total > 0 and balance > 0
+                      and (info['hoursToExpiry'] is None or info['hoursToExpiry'] > 0))
+    runway = [h for h in (info['hoursLeft'], info['hoursToExpiry']) if h is not None]
+    info['runway'] = min(runway) if runway else float('inf')
+    return info
+
+def choose_key(cache: UsageCache, keys: list, current: int, now: float = None) -> dict:
+    """预测式选 key：当前 key 预计在 ROTATE_AHEAD_HOURS 内耗尽/过期时提前换掉，用量未知时保留。
+    候选按 最早过期 → 燃烧速率最低（分散负载）→ 余额最多 排序；都不满足时退而求其次选 runway 最长的可用 key"""
+    import time
+    now = time.time() if now is None else now
+    assessed = [assess_key(cache.entry(k), now) for k in keys]
+    if not 1 <= current <= len(keys):
+        current = 1
+    cur = assessed[current - 1] if keys else None
+    if keys and cache.entry(keys[current - 1]) is None:
+        # 没有用量数据不代表 key 不可用，只在确认耗尽/即将耗尽时才轮换
+        return {'index': current, 'rotated': False, 'reason': 'usage unknown', **cur}
+    if cur and cur['usable'] and cur['runway'] > ROTATE_AHEAD_HOURS:
+        return {'index': current, 'rotated': False, 'reason': 'current key has enough runway', **cur}
+    usable = [(i + 1, a) for i, a in enumerate(assessed) if a['usable'] and i + 1 != current]
+    healthy = [(i, a) for i, a in usable if a['runway'] > ROTATE_AHEAD_HOURS]
+    if healthy:
+        idx, best = min(healthy, key=lambda x: (x[1]['hoursToExpiry'] if x[1]['hoursToExpiry'] is not None else float('inf'),
+                                                x[1]['burnRate'] or 0, -x[1]['balance']))
+        reason = 'current key exhausted or invalid' if not (cur and cur['usable']) else 'current key projected to run out soon'
+        return {'index': idx, 'rotated': True, 'reason': reason, **best}
+    if cur and cur['usable']:
+        return {'index': current, 'rotated': False, 'reason': 'no better key available', **cur}
+    if usable:
+        idx, best = max(usable, key=lambda x: x[1]['runway'])
+        return {'index': idx, 'rotated': True, 'reason': 'all keys low, picked longest runway', **best}
+    return {'index': None, 'rotated': False, 'reason': 'no usable key'}
+
+def pick_least_loaded(cache: UsageCache, records: list, counts: dict, now: float, max_per_key: int = 0):
+    """在多个会话/客户端之间分配 key：可用 key 中取 余额 / (已持有数 + 1) 最大者，
+    预计在 ROTATE_AHEAD_HOURS 内耗尽的排在后面；用量未知的 key 只在没有可用 key 时按持有数平均分配。
+    counts 为 key id -> 持有数；返回 1 起始的序号，没有可分配的 key 时返回 None"""
+    usable, unknown = [], []
+    for i, record in enumerate(records):
+        held = counts.get(record['id'], 0)
+        if max_per_key and held >= max_per_key:
+            continue
+        entry = cache.entry(record['key'])
+        if entry is None:
+            unknown.append((held, i))
+            continue
+        a = assess_key(entry, now)
+        if a['usable']:
+            usable.append((a['runway'] <= ROTATE_AHEAD_HOURS, -a['balance'] / (held + 1), held, i))
+    if usable:
+        return min(usable)[-1] + 1
+    if unknown:
+        return min(unknown)[-1] + 1
+    return None
+
+class EventHub:
+    """进程内发布/订阅，供 /api/events (SSE) 推送增量"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        import queue
+        q = queue.Queue(maxsize=256)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def has_subscribers(self) -> bool:
+        with self._lock:
+            return bool(self._subscribers)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event: str, data: dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((event, data))
+            except Exception:
+                pass  # 慢客户端队列已满时丢弃，客户端可通过 /api/usage 重新同步
+
+EVENTS = EventHub()
+
+WATCH_INTERVAL = float(os.environ.get('DKM_WATCH_INTERVAL', '1'))   # 文件变更检测间隔（秒）
+SSE_PING_INTERVAL = 15
+
+def _tree_sig(path: str):
+    """目录签名：目录自身 mtime + 子项 (名称, mtime, size)，用于发现增删改"""
+    try:
+        items = [os.stat(path).st_mtime_ns]
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                    items.append((entry.name, st.st_mtime_ns, st.st_size))
+                except OSError:
+                    continue
+        return tuple(sorted(items[1:])) + (items[0],)
+    except OSError:
+        return None
+
+class FileWatcher:
+    """轮询 current / keys.enc 以及 ~/.factory 下的配置，变化时发布事件；仅在有 SSE 订阅者时工作"""
+    def __init__(self, oroio_dir: str):
+        self.current_file = os.path.join(oroio_dir, 'current')
+        self.keys_file = os.path.join(oroio_dir, 'keys.enc')
+        self._lock = threading.Lock()
+        self._thread = None
+        self._sigs = {}
+
+    def _targets(self):
+        yield 'current', self.current_file, _file_sig
+        yield 'keys', self.keys_file, _file_sig
+        for name in ('mcp.json', 'config.json'):
+            yield name, os.path.join(FACTORY_DIR, name), _file_sig
+        for name in ('commands', 'droids', 'skills'):
+            yield name, os.path.join(FACTORY_DIR, name), _tree_sig
+
+    def _read_current(self) -> int:
+        try:
+            with open(self.current_file, 'r') as f:
+                return max(1, int(f.read().strip()))
+        except Exception:
+            return 1
+
+    def _scan(self, publish: bool):
+        for name, path, sig_fn in self._targets():
+            sig = sig_fn(path)
+            known = name in self._sigs
+            if known and self._sigs[name] == sig:
+                continue
+            self._sigs[name] = sig
+            if not (publish and known):
+                continue
+            if name == 'current':
+                EVENTS.publish('current', {'index': self._read_current()})
+            elif name == 'keys':
+                EVENTS.publish('keys', {'count': len(decrypt_keys(self.keys_file))})
+            else:
+                EVENTS.publish('config', {'name': name})
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='file-watcher', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        import time
+        self._sigs = {}
+        self._scan(publish=False)
+        while True:
+            with self._lock:
+                if not EVENTS.has_subscribers():
+                    self._thread = None
+                    return
+            time.sleep(WATCH_INTERVAL)
+            self._scan(publish=True)
+
+_file_watchers = {}
+_file_watchers_lock = threading.Lock()
+
+def get_file_watcher(oroio_dir: str) -> FileWatcher:
+    with _file_watchers_lock:
+        watcher = _file_watchers.get(oroio_dir)
+        if watcher is None:
+            watcher = _file_watchers[oroio_dir] = FileWatcher(oroio_dir)
+        return watcher
+
+def refresh_usage_cache(cache: UsageCache, keys_file: str, cache_file: str, keys: list,
+                        only: list = None, force: bool = False) -> int:
+    """只重新获取缺失/过期（或 only 指定）的 key，写回缓存并导出 list_cache.b64，返回实际获取数"""
+    cache.import_legacy(keys_file, cache_file, keys)
+    if only is not None:
+        targets = list(only)
+    elif force:
+        targets = list(keys)
+    else:
+        targets = cache.stale_keys(keys)
+        METRICS.inc('oroio_cache_requests_total', {'cache': 'usage', 'result': 'hit'}, len(keys) - len(targets))
+        METRICS.inc('oroio_cache_requests_total', {'cache': 'usage', 'result': 'miss'}, len(targets))
+    changed, samples = [], []
+    if targets:
+        import time
+        now = time.time()
+        for key, usage in zip(targets, refresh_usages(targets)):
+            if cache.get(key) != usage:
+                changed.append(key)
+            cache.put(key, usage, now)
+            if usage.get('TOTAL', 0) > 0 and not usage.get('RAW'):
+                samples.append((now, cache.fingerprint(key), usage.get('USED', 0), usage['TOTAL']))
+    if samples:
+        try:
+            get_usage_history(cache.oroio_dir).append(samples)
+        except OSError:
+            pass
+    cache.save()
+    cache.export_legacy(keys_file, cache_file, keys)
+    for key in changed:
+        entry = cache.entry(key)
+        for i, k in enumerate(keys):
+            if k == key:
+                EVENTS.publish('usage', {'index': i + 1, 'usage': entry['usage'], 'fetchedAt': entry['ts']})
+    return len(targets)
+
+def mask_key(key: str) -> str:
+    """与 dk 的 mask_key 一致"""
+    if len(key) <= 10:
+        return f'{key[:3]}***'
+    return f'{key[:6]}...{key[-4:]}'
+
+def parse_key_text(text: str) -> list:
+    """每行一个或以空白分隔的 key，# 之后为注释；兼容 dk add --file 的文件格式"""
+    keys = []
+    for line in text.splitlines():
+        keys.extend(line.split('#', 1)[0].split())
+    return keys
+
+def key_status(usage: dict) -> str:
+    """valid / exhausted / invalid（确定无效）/ error（网络、429、5xx，结果未知）"""
+    raw = usage.get('RAW', '')
+    if raw == 'http_error' or raw == 'http_429' or raw.startswith('http_5'):
+        return 'error'
+    if raw:
+        return 'invalid'
+    if usage.get('TOTAL', 0) > 0 and usage.get('BALANCE_NUM', 0) <= 0:
+        return 'exhausted'
+    return 'valid'
+
+def import_keys(oroio_dir: str, candidates: list, validate: bool = False,
+                keep_invalid: bool = False, progress=None) -> dict:
+    """批量导入：用集合去重（含已有 key），可选并发校验，最后只加密写入一次 keys.enc。
+    progress(event) 在每个 key 校验完成时回调"""
+    import time
+    keys_file = os.path.join(oroio_dir, 'keys.enc')
+    cache_file = os.path.join(oroio_dir, 'list_cache.b64')
+    keys = decrypt_keys(keys_file)
+    existing = set(keys)
+    seen = set()
+    fresh = []
+    duplicates = 0
+    for key in candidates:
+        key = key.strip()
+        if not key or key in seen:
+            duplicates += bool(key)
+            continue
+        seen.add(key)
+        if key not in existing:
+            fresh.append(key)
+    result = {'received': len(candidates), 'duplicates': duplicates,
+              'existing': len(seen) - len(fresh), 'invalid': 0, 'added': 0}
+    usages = {}
+    if validate and fresh:
+        counts = {}
+        for done, (i, usage) in enumerate(iter_usages(fresh), 1):
+            key = fresh[i]
+            usages[key] = usage
+            status = key_status(usage)
+            counts[status] = counts.get(status, 0) + 1
+            if progress:
+                progress({'type': 'key', 'key': mask_key(key), 'status': status,
+                          'balance': usage.get('BALANCE_NUM', 0), 'total': usage.get('TOTAL', 0),
+                          'done': done, 'count': len(fresh)})
+        if not keep_invalid:
+            fresh = [k for k in fresh if key_status(usages[k]) != 'invalid']
+        result['invalid'] = counts.get('invalid', 0)
+        result['validation'] = counts
+    with KEYS_WRITE_LOCK:
+        # 校验期间可能有其他写入，重新读取后再去重
+        keys = decrypt_keys(keys_file)
+        existing = set(keys)
+        fresh = [k for k in fresh if k not in existing]
+        if fresh:
+            keys.extend(fresh)
+            encrypt_keys(keys, keys_file)
+    if fresh:
+        if usages:
+            cache = get_usage_cache(oroio_dir)
+            now = time.time()
+            for key in fresh:
+                cache.put(key, usages[key], now)
+            refresh_usage_cache(cache, keys_file, cache_file, keys, only=[])
+    result['added'] = len(fresh)
+    result['count'] = len(keys)
+    return result
+
+POLL_INTERVAL = int(os.environ.get('DKM_POLL_INTERVAL', '300'))          # 后台全量轮询间隔（秒，0 关闭定时轮询）
+POLL_HOT_INTERVAL = int(os.environ.get('DKM_POLL_HOT_INTERVAL', '60'))   # 当前 key 与低余额 key 的轮询间隔
+LOW_BALANCE_RATIO = 0.10                                                # 与 dk 的 is_low_remain 一致
+
+class UsagePoller:
+    """后台用量轮询线程：定时刷新（当前 key 与低余额 key 更频繁），并接受非阻塞的"立即刷新"请求"""
+    def __init__(self, oroio_dir: str):
+        self.keys_file = os.path.join(oroio_dir, 'keys.enc')
+        self.current_file = os.path.join(oroio_dir, 'current')
+        self.cache_file = os.path.join(oroio_dir, 'list_cache.b64')
+        self.cache = get_usage_cache(oroio_dir)
+        self.last_poll = None
+        self.refreshing = False
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._started = 0
+        self._completed = 0
+        self._force = False
+        self._thread = None
+        self._round = None        # 进行中的一轮：(序号, 是否手动触发, 是否 force, keys.enc 签名)
+        self._last_manual = None  # 最近完成的手动一轮：(序号, 完成时间, 是否 force, keys.enc 签名)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='usage-poller', daemon=True)
+                self._thread.start()
+
+    def trigger(self, force: bool = False) -> int:
+        """请求尽快刷新一轮，立即返回该轮的序号（可交给 wait 使用）。
+        已有同等强度的手动刷新在进行时共享那一轮；上一轮手动刷新刚完成（DKM_REFRESH_DEBOUNCE 内）时直接复用。
+        keys.enc 在那一轮之后有变动时不复用"""
+        import time
+        self.start()
+        sig = _file_sig(self.keys_file)
+        with self._cond:
+            if self._requested <= self._started:
+                if self._round is not None:
+                    generation, manual, round_force, round_sig = self._round
+                    if manual and (round_force or not force) and round_sig == sig:
+                        METRICS.inc('oroio_refresh_coalesced_total', {'level': 'round', 'reason': 'inflight'})
+                        return generation
+                elif self._last_manual is not None and REFRESH_DEBOUNCE > 0:
+                    generation, finished, round_force, round_sig = self._last_manual
+                    if (time.monotonic() - finished < REFRESH_DEBOUNCE and (round_force or not force)
+                            and round_sig == sig):
+                        METRICS.inc('oroio_refresh_coalesced_total', {'level': 'round', 'reason': 'debounce'})
+                        return generation
+            target = self._started + 1
+            self._requested = max(self._requested, target)
+            self._force = self._force or force
+            self._cond.notify_all()
+            return target
+
+    def wait(self, target: int, timeout: float = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._completed >= target, timeout)
+
+    def _current_index(self) -> int:
+        return read_current_index(os.path.dirname(self.current_file))
+
+    def _due_keys(self, keys: list) -> list:
+        """定时轮询：当前 key 与低余额 key 按 POLL_HOT_INTERVAL，其余按 POLL_INTERVAL 与条目 TTL 中较大者"""
+        import time
+        now = time.time()
+        cur = self._current_index()
+        due = []
+        for i, key in enumerate(keys):
+            entry = self.cache.entry(key)
+            if entry is None:
+                due.append(key)
+                continue
+            usage = entry['usage']
+            total, balance = usage.get('TOTAL', 0), usage.get('BALANCE_NUM', 0)
+            hot = i + 1 == cur or (total > 0 and 0 < balance <= total * LOW_BALANCE_RATIO)
+            interval = POLL_HOT_INTERVAL if hot else max(POLL_INTERVAL, entry['ttl'])
+            if now - entry['ts'] >= interval:
+                due.append(key)
+        return due
+
+    def _loop(self):
+        import time
+        tick = max(5, min(POLL_HOT_INTERVAL, POLL_INTERVAL)) if POLL_INTERVAL > 0 else None
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._requested > self._started, tick)
+                triggered = self._requested > self._started
+                force, self._force = self._force, False
+                self._started += 1
+                generation = self._started
+                self._round = (generation, triggered, force, _file_sig(self.keys_file))
+                self.refreshing = True
+            try:
+                keys = decrypt_keys(self.keys_file)
+                if keys:
+                    if triggered:
+                        refresh_usage_cache(self.cache, self.keys_file, self.cache_file, keys, force=force)
+                    else:
+                        due = self._due_keys(keys)
+                        if due:
+                            refresh_usage_cache(self.cache, self.keys_file, self.cache_file, keys, only=due)
+                self.last_poll = time.time()
+            except Exception:
+                pass
+            finally:
+                with self._cond:
+                    round_sig = self._round[3]
+                    self.refreshing = False
+                    self._round = None
+                    if triggered:
+                        self._last_manual = (generation, time.monotonic(), force, round_sig)
+                    self._completed = generation
+                    self._cond.notify_all()
+
+_usage_pollers = {}
+_usage_pollers_lock = threading.Lock()
+
+def get_usage_poller(oroio_dir: str) -> UsagePoller:
+    with _usage_pollers_lock:
+        poller = _usage_pollers.get(oroio_dir)
+        if poller is None:
+            poller = _usage_pollers[oroio_dir] = UsagePoller(oroio_dir)
+        return poller
+
+def read_current_index(oroio_dir: str) -> int:
+    try:
+        with open(os.path.join(oroio_dir, 'current'), 'r') as f:
+            return max(1, int(f.read().strip()))
+    except Exception:
+        return 1
+
+def write_current_index(oroio_dir: str, idx: int):
+    with trace_phase('disk_write'), open(os.path.join(oroio_dir, 'current'), 'w') as f:
+        f.write(str(idx))
+
+def current_key_state(oroio_dir: str, rotate: bool = False) -> dict:
+    """当前 key 及其缓存用量；rotate=True 时先按 choose_key 做预测式轮换。没有 key 时返回 None"""
+    keys_file = os.path.join(oroio_dir, 'keys.enc')
+    keys = decrypt_keys(keys_file)
+    if not keys:
+        return None
+    cache = get_usage_cache(oroio_dir)
+    current = read_current_index(oroio_dir)
+    if current > len(keys):
+        current = 1
+    idx, rotated = current, False
+    if rotate:
+        decision = choose_key(cache, keys, current)
+        if decision['index'] is not None:
+            idx, rotated = decision['index'], decision['rotated']
+            if rotated:
+                write_current_index(oroio_dir, idx)
+    key = keys[idx - 1]
+    if cache.stale_keys([key]):
+        get_usage_poller(oroio_dir).trigger()
+    entry = cache.entry(key)
+    return {'index': idx, 'key': key, 'rotated': rotated, 'usage': entry['usage'] if entry else None}
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+class LocalLeases:
+    """本机并发 dk run 的 key 租约：run/leases.json 记录 {dk 进程 pid: key id}，读写时持有 run/leases.lock 的 flock。
+    没有其他会话时与 current_key_state(rotate=True) 的选择一致；已有会话占用该 key 时按 pick_least_loaded 换一个。
+    持有者进程退出后（包括被 kill）其租约在下一次申请时清理，无需心跳"""
+    def __init__(self, oroio_dir: str):
+        self.oroio_dir = oroio_dir
+        self.keys_file = os.path.join(oroio_dir, 'keys.enc')
+        run_dir = os.path.join(oroio_dir, 'run')
+        self.state_file = os.path.join(run_dir, 'leases.json')
+        self.lock_file = os.path.join(run_dir, 'leases.lock')
+
+    def _locked(self):
+        import contextlib
+        import fcntl
+
+        @contextlib.contextmanager
+        def locked():
+            os.makedirs(os.path.dirname(self.lock_file), mode=0o700, exist_ok=True)
+            with open(self.lock_file, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return locked()
+
+    def _load(self, ids: set) -> dict:
+        try:
+            with open(self.state_file) as f:
+                leases = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {pid: lease for pid, lease in leases.items()
+                if pid.isdigit() and lease.get('id') in ids and _pid_alive(int(pid))}
+
+    def _store(self, leases: dict):
+        atomic_write(self.state_file, json.dumps(leases).encode('utf-8'))
+
+    def acquire(self, pid: int) -> dict:
+        """为 pid 选 key 并登记；返回 current_key_state 的字段外加 leases（该 key 上的会话数，含本次）。没有 key 时返回 None"""
+        import time
+        records = read_key_records(self.keys_file)
+        if not records:
+            return None
+        keys = [r['key'] for r in records]
+        cache = get_usage_cache(self.oroio_dir)
+        with self._locked():
+            now = time.time()
+            leases = self._load({r['id'] for r in records})
+            leases.pop(str(pid), None)
+            counts = {}
+            for lease in leases.values():
+                counts[lease['id']] = counts.get(lease['id'], 0) + 1
+            current = read_current_index(self.oroio_dir)
+            if current > len(keys):
+                current = 1
+            decision = choose_key(cache, keys, current)
+            idx, rotated = decision['index'] or current, False
+            if counts.get(records[idx - 1]['id']):
+                # 其他会话已在用这个 key：分到负载最低的 key，不改动 current
+                idx = pick_least_loaded(cache, records, counts, now) or idx
+            elif decision['rotated']:
+                write_current_index(self.oroio_dir, idx)
+                rotated = True
+            record = records[idx - 1]
+            leases[str(pid)] = {'id': record['id'], 'started': int(now)}
+            self._store(leases)
+        entry = cache.entry(record['key'])
+        return {'index': idx, 'key': record['key'], 'rotated': rotated, 'leases': counts.get(record['id'], 0) + 1,
+                'usage': entry['usage'] if entry else None}
+
+    def release(self, pid: int) -> bool:
+        with self._locked():
+            try:
+                with open(self.state_file) as f:
+                    leases = json.load(f)
+            except (OSError, ValueError):
+                return False
+            if leases.pop(str(pid), None) is None:
+                return False
+            self._store(leases)
+            return True
+
+# 本机查询 socket：dk run / dk current 通过 `curl --unix-socket` 一次往返取得当前 key 与用量，
+# 不必在 bash 中 fork openssl 解密、逐行解码缓存。放在 0700 的 run/ 目录下，仅当前用户可连接。
+QUERY_SOCKET = os.environ.get('DKM_SOCKET', '')
+
+def query_socket_path(oroio_dir: str) -> str:
+    return QUERY_SOCKET or os.path.join(oroio_dir, 'run', 'serve.sock')
+
+def format_key_state(state: dict) -> str:
+    """current_key_state / LocalLeases.acquire 的结果转为 dk 解析的 KEY=VALUE 行"""
+    lines = [f"INDEX={state['index']}", f"KEY={state['key']}", f"ROTATED={int(state['rotated'])}"]
+    if 'leases' in state:
+        lines.append(f"LEASES={state['leases']}")
+    usage = state['usage']
+    if usage is not None:
+        for name in ('BALANCE', 'BALANCE_NUM', 'TOTAL', 'USED', 'EXPIRES', 'RAW'):
+            lines.append(f'{name}={usage.get(name, "")}')
+    return '\n'.join(lines) + '\n'
+
+class KeyQueryHandler(http.server.BaseHTTPRequestHandler):
+    """GET /current 或 /rotate，返回与 dk fetch_usage 相同的 KEY=VALUE 行，外加 INDEX/KEY/ROTATED。
+    GET /lease?pid=N 为 dk run 会话申请本机租约（外加 LEASES），/release?pid=N 释放"""
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path
+        if path == '/ping':
+            self._send_text('ok\n')
+            return
+        if path not in ('/current', '/rotate', '/lease', '/release'):
+            self.send_error(404, 'Not Found')
+            return
+        try:
+            if path in ('/lease', '/release'):
+                from urllib.parse import parse_qsl
+                pid = int(dict(parse_qsl(parts.query)).get('pid', '0'))
+                if pid <= 0:
+                    self.send_error(400, 'pid required')
+                    return
+                leases = LocalLeases(self.server.oroio_dir)
+                if path == '/release':
+                    self._send_text(f'RELEASED={int(leases.release(pid))}\n')
+                    return
+                state = leases.acquire(pid)
+                if state is not None and get_usage_cache(self.server.oroio_dir).stale_keys([state['key']]):
+                    get_usage_poller(self.server.oroio_dir).trigger()
+            else:
+                state = current_key_state(self.server.oroio_dir, rotate=path == '/rotate')
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        if state is None:
+            self.send_error(404, 'No keys')
+            return
+        self._send_text(format_key_state(state))
+
+    def _send_text(self, text: str):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_query_socket(oroio_dir: str):
+    """在 oroio_dir/run/serve.sock 上启动查询服务（后台线程）。不支持 AF_UNIX 或已有实例在监听时返回 None"""
+    import atexit
+    import socket
+    import socketserver
+    if IS_WINDOWS or not hasattr(socket, 'AF_UNIX'):
+        return None
+    path = query_socket_path(oroio_dir)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(path), 0o700)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return None  # 另一个 serve/daemon 正在服务
+        except OSError:
+            os.unlink(path)  # 上次异常退出遗留
+        finally:
+            probe.close()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(path, KeyQueryHandler)
+    finally:
+        os.umask(old_umask)
+    server.oroio_dir = oroio_dir
+
+    def cleanup():
+        try:
+            if os.stat(path).st_ino == server_ino:
+                os.unlink(path)
+        except OSError:
+            pass
+
+    server_ino = os.stat(path).st_ino
+    atexit.register(cleanup)
+    threading.Thread(target=server.serve_forever, name='query-socket', daemon=True).start()
+    return server
+
+try:
+    import brotli  # 可选依赖，缺失时只提供 gzip
+except ImportError:
+    brotli = None
+
+STATIC_COMPRESS_MIN = 1024                 # 小于此大小的文件不压缩
+STATIC_SENDFILE_MIN = 64 * 1024            # 未压缩响应超过此大小时用 sendfile 直接从文件发送
+STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml',
+                      'application/wasm', 'application/xml')
+
+def accepted_encodings(header: str) -> set:
+    """解析 Accept-Encoding，返回可接受的编码（忽略 q=0）"""
+    result = set()
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        result.add(name)
+    return result
+
+class StaticAssetCache:
+    """静态资源缓存：按文件签名失效，首次访问时计算内容哈希 ETag 与 br/gzip 压缩版本"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
 
-def decrypt_keys(keys_file: str) -> list:
-    """解密 keys.enc 文件，返回 key 列表"""
-    if not os.path.isfile(keys_file):
-        return []
-    try:
-        if IS_WINDOWS:
-            with open(keys_file, 'rb') as f:
-                data = f.read()
-            if len(data) < 17 or data[:8] != b'Salted__':
-                return []
-            salt, ciphertext = data[8:16], data[16:]
-            key, iv = _derive_key_iv(salt)
-            cipher = AESCipher(key, iv)
-            text = cipher.decrypt(ciphertext).decode('utf-8')
-        else:
-            result = subprocess.run(
-                ['openssl', 'enc', '-d', '-aes-256-cbc', '-pbkdf2', '-in', keys_file, '-pass', f'pass:{SALT.decode()}'],
-                capture_output=True
-            )
-            if result.returncode != 0:
+    def _build(self, filepath: str, sig, ctype: str) -> dict:
+        import gzip
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        entry = {
+            'sig': sig,
+            'type': ctype,
+            'size': len(content),
+            'etag': digest,
+            # 大文件不常驻内存，发送时走 sendfile
+            'body': content if len(content) < STATIC_SENDFILE_MIN else None,
+            'variants': {},
+        }
+        if len(content) >= STATIC_COMPRESS_MIN and ctype.startswith(COMPRESSIBLE_TYPES):
+            gz = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gz) < len(content):
+                entry['variants']['gzip'] = gz
+            if brotli is not None:
+                br = brotli.compress(content)
+                if len(br) < len(gz):
+                    entry['variants']['br'] = br
+        return entry
+
+    def get(self, filepath: str, ctype: str) -> dict:
+        sig = _file_sig(filepath)
+        if sig is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(filepath)
+        if entry is not None and entry['sig'] == sig:
+            METRICS.inc('oroio_cache_requests_total', {'cache': 'static', 'result': 'hit'})
+            return entry
+        METRICS.inc('oroio_cache_requests_total', {'cache': 'static', 'result': 'miss'})
+        entry = self._build(filepath, sig, ctype)
+        with self._lock:
+            self._entries[filepath] = entry
+        return entry
+
+    @staticmethod
+    def select(entry: dict, accept: set):
+        """按 br > gzip > identity 选择编码，返回 (encoding, body)"""
+        for enc in ('br', 'gzip'):
+            if enc in accept and enc in entry['variants']:
+                return enc, entry['variants'][enc]
+        return None, entry['body']
+
+STATIC_CACHE = StaticAssetCache()
+
+class FactoryPaths:
+    """~/.factory 下各资源路径，启动时解析一次（含 realpath），请求处理中不再重复计算"""
+
+    def __init__(self, root: str = FACTORY_DIR):
+        self.root = root
+        self.skills = os.path.realpath(os.path.join(root, 'skills'))
+        self.commands = os.path.realpath(os.path.join(root, 'commands'))
+        self.droids = os.path.realpath(os.path.join(root, 'droids'))
+        self.mcp = os.path.join(root, 'mcp.json')
+        self.config = os.path.join(root, 'config.json')
+
+FACTORY_PATHS = FactoryPaths()
+
+FRONTMATTER_MAX_LINES = 256
+
+def read_frontmatter(path: str) -> dict:
+    """只读取文件开头 --- 包围的 frontmatter（顶层 key: value），不读正文"""
+    meta = {}
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        if f.readline().rstrip() != '---':
+            return {}
+        for i, line in enumerate(f):
+            if line.rstrip() == '---':
+                return meta
+            if i >= FRONTMATTER_MAX_LINES:
+                break
+            key, sep, val = line.partition(':')
+            if sep and not line[:1].isspace():
+                meta[key.strip()] = val.strip()
+    return {}
+
+class ResourceCatalog:
+    """skills / commands / droids 的元数据索引。
+
+    目录 mtime 未变时不重新 listdir，只 stat 已知条目；文件签名变化才重读 frontmatter。
+    layout='file' 为 <name>.md，layout='dir' 为 <name>/SKILL.md。
+    """
+
+    def __init__(self, root: str, layout: str = 'file'):
+        self.root = root
+        self.layout = layout
+        self._dir_sig = None
+        self._names = []
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def entry_path(self, name: str) -> str:
+        if self.layout == 'dir':
+            return os.path.join(self.root, name, 'SKILL.md')
+        return os.path.join(self.root, f'{name}.md')
+
+    def _list_names(self) -> list:
+        names = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if self.layout == 'dir':
+                    if entry.is_dir():
+                        names.append(entry.name)
+                elif entry.name.endswith('.md'):
+                    names.append(entry.name[:-3])
+        return names
+
+    def _load(self, name: str, path: str, st, sig) -> dict:
+        try:
+            desc = read_frontmatter(path).get('description') or None
+        except OSError:
+            desc = None
+        return {'name': name, 'path': path, 'description': desc,
+                'size': st.st_size, 'mtime': st.st_mtime, 'sig': sig}
+
+    def list(self) -> list:
+        """返回按名称排序的元数据列表（不含正文）"""
+        import stat
+        with self._lock:
+            dir_sig = _file_sig(self.root)
+            if dir_sig is None:
+                self._dir_sig, self._names, self._entries = None, [], {}
                 return []
-            text = result.stdout.decode('utf-8')
-        keys = []
-        for line in text.split('\n'):
-            line = line.strip()
-            if line:
-                keys.append(line.split('\t')[0])
-        return keys
-    except Exception:
-        return []
+            if dir_sig != self._dir_sig:
+                try:
+                    self._names = self._list_names()
+                except OSError:
+                    self._names = []
+                self._dir_sig = dir_sig
+            entries = {}
+            for name in self._names:
+                path = self.entry_path(name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+                item = self._entries.get(name)
+                if item is None or item['sig'] != sig:
+                    item = self._load(name, path, st, sig)
+                entries[name] = item
+            self._entries = entries
+            items = sorted(entries.values(), key=lambda x: x['name'].lower())
+        return [{k: v for k, v in item.items() if k != 'sig'} for item in items]
 
-def encrypt_keys(keys: list, keys_file: str):
-    """加密 key 列表并写入文件"""
-    text = '\n'.join(f"{k}\t" for k in keys)
-    if IS_WINDOWS:
-        import secrets
-        salt = secrets.token_bytes(8)
-        key, iv = _derive_key_iv(salt)
-        cipher = AESCipher(key, iv)
-        ciphertext = cipher.encrypt(text.encode('utf-8'))
-        with open(keys_file, 'wb') as f:
-            f.write(b'Salted__' + salt + ciphertext)
-    else:
-        subprocess.run(
-            ['openssl', 'enc', '-aes-256-cbc', '-pbkdf2', '-salt', '-out', keys_file, '-pass', f'pass:{SALT.decode()}'],
-            input=text.encode('utf-8'),
-            check=True
-        )
+    def invalidate(self):
+        """写操作后调用，下次 list 时重新 listdir"""
+        with self._lock:
+            self._dir_sig = None
 
-API_URL = 'https://app.factory.ai/api/organization/members/chat-usage'
-API_TIMEOUT = 8
-API_RETRIES = 3
-FACTORY_DIR = os.path.join(os.path.expanduser('~'), '.factory')
+SKILL_CATALOG = ResourceCatalog(FACTORY_PATHS.skills, layout='dir')
+COMMAND_CATALOG = ResourceCatalog(FACTORY_PATHS.commands)
+DROID_CATALOG = ResourceCatalog(FACTORY_PATHS.droids)
 
-def fetch_usage(key: str) -> dict:
-    """获取单个 key 的用量信息，带重试机制"""
-    import time
-    result = {'BALANCE': 0, 'BALANCE_NUM': 0, 'TOTAL': 0, 'USED': 0, 'EXPIRES': '?', 'RAW': ''}
-    last_error = None
-    
-    for attempt in range(API_RETRIES):
-        try:
-            req = urllib.request.Request(API_URL, headers={
-                'Authorization': f'Bearer {key}',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
-            with urllib.request.urlopen(req, timeout=API_TIMEOUT) as resp:
-                data = json.loads(resp.read().decode('utf-8'))
-            usage = data.get('usage')
-            if not usage:
-                result['RAW'] = 'no_usage'
-                return result
-            section = usage.get('standard') or usage.get('premium') or usage.get('total') or usage.get('main')
-            if section:
-                total = section.get('totalAllowance') or section.get('basicAllowance') or section.get('allowance')
-                used = section.get('orgTotalTokensUsed') or section.get('used') or section.get('tokensUsed') or 0
-                used += section.get('orgOverageUsed') or 0
-                if total is not None:
-                    result['TOTAL'] = int(total)
-                    result['USED'] = int(used)
-                    result['BALANCE_NUM'] = int(total - used)
-                    result['BALANCE'] = result['BALANCE_NUM']
-            exp_raw = usage.get('endDate') or usage.get('expire_at') or usage.get('expires_at')
-            if exp_raw is not None:
-                if isinstance(exp_raw, (int, float)) or (isinstance(exp_raw, str) and exp_raw.isdigit()):
-                    from datetime import datetime
-                    result['EXPIRES'] = datetime.utcfromtimestamp(int(exp_raw) / 1000).strftime('%Y-%m-%d')
+CATALOGS = {'skill': SKILL_CATALOG, 'command': COMMAND_CATALOG, 'droid': DROID_CATALOG}
+
+SEARCH_FIELD_WEIGHTS = {'name': 5, 'description': 3, 'body': 1}
+SEARCH_SNIPPET_CHARS = 160
+
+def tokenize(text: str) -> list:
+    """小写后切分：连续字母数字为一个词，CJK 按单字切分"""
+    import re
+    return re.findall(r'[0-9a-z_]+|[\u3400-\u9fff]', text.lower())
+
+class SearchIndex:
+    """commands / droids / skills 的增量倒排索引。
+
+    查询前按目录签名同步，只重读变化的文件；写接口直接调用 reindex/remove。
+    词项以有序列表保存，前缀查询通过二分定位。
+    """
+
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self, catalogs: dict):
+        self.catalogs = catalogs
+        self._docs = {}        # doc_id -> 文档
+        self._ids = {}         # (kind, name) -> doc_id
+        self._postings = {}    # term -> {doc_id: 加权词频}
+        self._terms = []       # 有序词项，用于前缀展开
+        self._total_len = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def _add(self, kind: str, item: dict, content: str):
+        from collections import Counter
+        doc_id = self._next_id
+        self._next_id += 1
+        desc = item.get('description') or ''
+        tf = Counter()
+        for field, text in (('name', item['name']), ('description', desc), ('body', content)):
+            weight = SEARCH_FIELD_WEIGHTS[field]
+            for term in tokenize(text):
+                tf[term] += weight
+        length = sum(tf.values())
+        for term, freq in tf.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                bisect.insort(self._terms, term)
+            postings[doc_id] = freq
+        self._docs[doc_id] = {
+            'kind': kind, 'name': item['name'], 'path': item['path'], 'description': item.get('description'),
+            'sig': (item['mtime'], item['size']), 'content': content, 'terms': list(tf), 'len': length,
+        }
+        self._ids[(kind, item['name'])] = doc_id
+        self._total_len += length
+
+    def _remove(self, kind: str, name: str):
+        doc_id = self._ids.pop((kind, name), None)
+        if doc_id is None:
+            return
+        doc = self._docs.pop(doc_id)
+        self._total_len -= doc['len']
+        for term in doc['terms']:
+            postings = self._postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[term]
+                i = bisect.bisect_left(self._terms, term)
+                if i < len(self._terms) and self._terms[i] == term:
+                    del self._terms[i]
+
+    def _index_item(self, kind: str, item: dict):
+        try:
+            with open(item['path'], 'r', encoding='utf-8', errors='replace') as f:
+                content = f.read()
+        except OSError:
+            return
+        self._remove(kind, item['name'])
+        self._add(kind, item, content)
+
+    def sync(self):
+        """与目录对齐：新增/变化的文件重新索引，已删除的移除"""
+        listings = {kind: catalog.list() for kind, catalog in self.catalogs.items()}
+        with self._lock:
+            for kind, items in listings.items():
+                seen = set()
+                for item in items:
+                    seen.add(item['name'])
+                    doc_id = self._ids.get((kind, item['name']))
+                    if doc_id is None or self._docs[doc_id]['sig'] != (item['mtime'], item['size']):
+                        self._index_item(kind, item)
+                for (k, name) in [key for key in self._ids if key[0] == kind and key[1] not in seen]:
+                    self._remove(k, name)
+
+    def reindex(self, kind: str, name: str):
+        """写接口调用：只重读这一个文件"""
+        catalog = self.catalogs[kind]
+        path = catalog.entry_path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(kind, name)
+            return
+        try:
+            desc = read_frontmatter(path).get('description') or None
+        except OSError:
+            desc = None
+        item = {'name': name, 'path': path, 'description': desc, 'size': st.st_size, 'mtime': st.st_mtime}
+        with self._lock:
+            self._index_item(kind, item)
+
+    def remove(self, kind: str, name: str):
+        with self._lock:
+            self._remove(kind, name)
+
+    def _expand(self, token: str, prefix: bool) -> list:
+        if not prefix:
+            return [token] if token in self._postings else []
+        i = bisect.bisect_left(self._terms, token)
+        out = []
+        while i < len(self._terms) and self._terms[i].startswith(token):
+            out.append(self._terms[i])
+            i += 1
+        return out
+
+    def search(self, query: str, kinds=None, limit: int = 20) -> dict:
+        """多个词取交集；以 * 结尾（或查询的最后一个词）按前缀匹配。BM25 排序"""
+        import math
+        self.sync()
+        words = query.split()
+        groups = []
+        for wi, word in enumerate(words):
+            prefix = word.endswith('*') or (wi == len(words) - 1 and not query.endswith(' '))
+            for token in tokenize(word.rstrip('*')):
+                groups.append((token, prefix))
+        if not groups:
+            return {'total': 0, 'results': []}
+        with self._lock:
+            n_docs = len(self._docs) or 1
+            avg_len = (self._total_len / n_docs) or 1
+            scores = None
+            matched_terms = {}
+            for token, prefix in groups:
+                group_scores = {}
+                for term in self._expand(token, prefix):
+                    postings = self._postings[term]
+                    idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for doc_id, tf in postings.items():
+                        doc = self._docs[doc_id]
+                        if kinds and doc['kind'] not in kinds:
+                            continue
+                        norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * doc['len'] / avg_len)
+                        group_scores[doc_id] = group_scores.get(doc_id, 0.0) + idf * tf * (self.BM25_K1 + 1) / (tf + norm)
+                        matched_terms.setdefault(doc_id, set()).add(term)
+                if scores is None:
+                    scores = group_scores
                 else:
-                    result['EXPIRES'] = str(exp_raw)
-            return result
-        except urllib.error.HTTPError as e:
-            result['RAW'] = f'http_{e.code}'
-            result['EXPIRES'] = 'Invalid key'
-            return result
-        except Exception as e:
-            last_error = e
-            if attempt < API_RETRIES - 1:
-                time.sleep(0.5)
-                continue
-    
-    result['RAW'] = 'http_error'
-    result['EXPIRES'] = 'Invalid key'
-    return result
+                    scores = {d: s + group_scores[d] for d, s in scores.items() if d in group_scores}
+                if not scores:
+                    break
+            ranked = sorted(scores.items(), key=lambda x: (-x[1], self._docs[x[0]]['name'].lower()))
+            results = []
+            for doc_id, score in ranked[:limit]:
+                doc = self._docs[doc_id]
+                snippet, highlights = make_snippet(doc['content'], matched_terms.get(doc_id, ()))
+                results.append({'kind': doc['kind'], 'name': doc['name'], 'path': doc['path'],
+                                'description': doc['description'], 'score': round(score, 4),
+                                'snippet': snippet, 'highlights': highlights})
+        return {'total': len(ranked), 'results': results}
 
-def fetch_all_usages(keys: list) -> list:
-    """并发获取所有 key 的用量"""
-    max_workers = min(6, len(keys)) if keys else 1
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        return list(executor.map(fetch_usage, keys))
+def make_snippet(content: str, terms) -> tuple:
+    """以首个命中词为中心截取片段，返回 (片段, 片段内命中区间列表)"""
+    import re
+    if content.startswith('---'):
+        # 描述已单独返回，片段从正文开始
+        end = content.find('\n---', 3)
+        if end != -1:
+            content = content[end + 4:]
+    text = ' '.join(content.split())
+    if not terms:
+        return text[:SEARCH_SNIPPET_CHARS], []
+    pattern = re.compile('|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(text)
+    if first is None:
+        return text[:SEARCH_SNIPPET_CHARS], []
+    start = max(0, first.start() - SEARCH_SNIPPET_CHARS // 3)
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    snippet = text[start:end]
+    highlights = [[m.start(), m.end()] for m in pattern.finditer(snippet)]
+    if start > 0:
+        snippet = '…' + snippet
+        highlights = [[a + 1, b + 1] for a, b in highlights]
+    if end < len(text):
+        snippet += '…'
+    return snippet, highlights
+
+SEARCH_INDEX = SearchIndex(CATALOGS)
+
+def atomic_write(path: str, data: bytes):
+    """临时文件 + fsync + rename，保留原文件权限；崩溃时只会留下旧文件或新文件"""
+    import tempfile
+    with trace_phase('disk_write'):
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp_file, os.stat(path).st_mode & 0o7777)
+            except OSError:
+                pass
+            os.replace(tmp_file, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            raise
+        if not IS_WINDOWS:
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                pass
+
+class ConfigFileError(ValueError):
+    """配置文件存在但无法解析；不能当作空配置，否则下一次修改会覆盖用户的文件"""
+
+class JsonFileStore:
+    """JSON 配置文件的内存副本。
+
+    读取按文件签名重新校验；修改在锁内作用于副本，失败不影响缓存；
+    落盘采用组提交：并发修改期间只写最新版本，已被他人写出的版本直接跳过。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = {}
+        self._sig = False       # False 表示尚未加载
+        self._version = 0       # 内存中的修改版本
+        self._written = 0       # 已落盘的版本
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.writes = 0
+
+    def _current(self) -> dict:
+        # 有未落盘的修改时以内存为准，否则按签名重新加载
+        if self._version > self._written:
+            return self._data
+        sig = _file_sig(self.path)
+        if sig != self._sig:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            except ValueError as e:
+                # 不记录签名：文件修好后下一次读取重新加载
+                raise ConfigFileError(f'{self.path} is not valid JSON: {e}')
+            if not isinstance(data, dict):
+                raise ConfigFileError(f'{self.path} must contain a JSON object')
+            self._data = data
+            self._sig = sig
+        return self._data
+
+    def read(self) -> dict:
+        import copy
+        with self._lock:
+            return copy.deepcopy(self._current())
+
+    def update(self, mutate):
+        """mutate(data) 就地修改副本并返回结果；抛出异常时不做任何修改。内容未变化时不写盘"""
+        import copy
+        with self._lock:
+            current = self._current()
+            data = copy.deepcopy(current)
+            result = mutate(data)
+            if data == current:
+                return result
+            self._data = data
+            self._version += 1
+            version = self._version
+        self._flush(version)
+        return result
+
+    def _flush(self, version: int):
+        with self._write_lock:
+            if self._written >= version:
+                return
+            with self._lock:
+                body = json.dumps(self._data, indent=2).encode('utf-8')
+                latest = self._version
+            atomic_write(self.path, body)
+            with self._lock:
+                self._written = latest
+                self._sig = _file_sig(self.path)
+                self.writes += 1
+
+MCP_STORE = JsonFileStore(FACTORY_PATHS.mcp)
+FACTORY_CONFIG_STORE = JsonFileStore(FACTORY_PATHS.config)
+
+def apply_mcp_op(config: dict, op: dict):
+    """对 mcp.json 应用一个修改：mcp.add / mcp.update / mcp.remove"""
+    kind = op.get('op')
+    name = str(op.get('name', '')).strip()
+    if kind == 'mcp.add':
+        command = str(op.get('command', '')).strip()
+        if not name or not command:
+            raise ValueError('Name and command are required')
+        config.setdefault('mcpServers', {})[name] = {'command': command, 'args': op.get('args', [])}
+        return
+    if not name:
+        raise ValueError('Name is required')
+    if kind == 'mcp.update':
+        config.setdefault('mcpServers', {})[name] = op.get('config', {})
+    elif kind == 'mcp.remove':
+        config.get('mcpServers', {}).pop(name, None)
+    else:
+        raise ValueError(f'Unknown op: {kind}')
+
+def apply_byok_op(config: dict, op: dict):
+    """对 config.json 的 custom_models 应用一个修改：byok.update / byok.remove"""
+    kind = op.get('op')
+    models = config.get('custom_models', [])
+    index = op.get('index')
+    if kind == 'byok.update':
+        model_config = op.get('config')
+        if model_config is None:
+            raise ValueError('Config is required')
+        if index is None or int(index) < 0:
+            # Add new model (index is None or -1)
+            models.append(model_config)
+        else:
+            idx = int(index)
+            if idx >= len(models):
+                raise ValueError('Index out of range')
+            models[idx] = model_config
+    elif kind == 'byok.remove':
+        if index is None:
+            raise ValueError('Index is required')
+        idx = int(index)
+        if idx < 0 or idx >= len(models):
+            raise ValueError('Index out of range')
+        models.pop(idx)
+    else:
+        raise ValueError(f'Unknown op: {kind}')
+    config['custom_models'] = models
+
+# op 前缀 -> (存储, 应用函数)
+CONFIG_OPS = {'mcp': (MCP_STORE, apply_mcp_op), 'byok': (FACTORY_CONFIG_STORE, apply_byok_op)}
+
+KEEPALIVE = os.environ.get('DKM_KEEPALIVE', '1') == '1'                  # HTTP/1.1 持久连接
+KEEPALIVE_TIMEOUT = float(os.environ.get('DKM_KEEPALIVE_TIMEOUT', '15'))  # 空闲连接保持秒数
+KEEPALIVE_MAX = int(os.environ.get('DKM_KEEPALIVE_MAX', '100'))          # 单个连接最多处理的请求数（0 不限）
+# 请求已完整读取的 4xx 不必断开连接；其余错误（400、超时、过大等）连接状态不可信，仍然关闭
+KEEPALIVE_ERROR_CODES = (401, 403, 404, 405)
+SERVE_WORKERS = int(os.environ.get('DKM_SERVE_WORKERS', '16'))          # 处理请求的固定线程数
+SERVE_QUEUE = int(os.environ.get('DKM_SERVE_QUEUE', '64'))              # 等待 worker 的连接上限，超出直接回 503
+SSE_MAX_STREAMS = int(os.environ.get('DKM_SSE_MAX', '32'))               # 同时保持的 SSE 连接上限
+
+def read_request_body(rfile, headers) -> bytes:
+    """按 Content-Length 或 Transfer-Encoding: chunked 读完请求体，持久连接上的下一个请求才能正确解析。
+    chunked 格式错误时抛出 ValueError"""
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int(rfile.readline(1024).split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                while rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(rfile.read(size))
+            rfile.readline(1024)
+        return b''.join(chunks)
+    length = int(headers.get('Content-Length') or 0)
+    return rfile.read(length) if length > 0 else b''
+
+# (method, path) -> (handler, options)，由 @route 注册
+ROUTES = {}
+
+def route(path: str, methods=('POST',), auth: bool = True, local: bool = False):
+    """注册 API 处理函数。auth=False 无需 token；local=True 时来自回环地址的请求（本机 dk）无需 PIN"""
+    def register(func):
+        for method in methods:
+            ROUTES[(method, path)] = (func, {'auth': auth, 'local': local})
+        return func
+    return register
+
+
+class PooledKeepAliveMixin:
+    """线程池模式下，持久连接在空闲等待期间若有其他连接排队，就主动关闭以让出 worker"""
+    def handle(self):
+        if not hasattr(self.server, 'overloaded'):
+            super().handle()
+            return
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._await_next_request():
+            self.handle_one_request()
+
+    def _await_next_request(self) -> bool:
+        import select
+        import time
+        # 缓冲区里已有下一个请求（pipelining）时直接处理
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        deadline = time.monotonic() + (self.timeout or KEEPALIVE_TIMEOUT)
+        while not self.server.overloaded():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [], min(0.25, remaining))
+            except (OSError, ValueError):
+                return False
+            if readable:
+                return True
+        return False
+
+class OroioHandler(PooledKeepAliveMixin, http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' if KEEPALIVE else 'HTTP/1.0'
+    timeout = KEEPALIVE_TIMEOUT if KEEPALIVE else None
+    # 头部与 body 分两次写出，持久连接上 Nagle 会与客户端的延迟 ACK 叠加出 ~40ms 延迟
+    disable_nagle_algorithm = True
 
-def write_cache(keys_file: str, cache_file: str, keys: list, usages: list):
-    """写入缓存文件，格式与 dk/dk.ps1 兼容"""
-    import time
-    now = int(time.time())
-    keys_hash = hashlib.sha1(open(keys_file, 'rb').read()).hexdigest()
-    lines = [str(now), keys_hash]
-    for i, u in enumerate(usages):
-        info = '\n'.join([
-            f"BALANCE={u.get('BALANCE', 0)}",
-            f"BALANCE_NUM={u.get('BALANCE_NUM', 0)}",
-            f"TOTAL={u.get('TOTAL', 0)}",
-            f"USED={u.get('USED', 0)}",
-            f"EXPIRES={u.get('EXPIRES', '?')}",
-            f"RAW={u.get('RAW', '')}"
-        ])
-        b64 = base64.b64encode(info.encode('utf-8')).decode('ascii')
-        lines.append(f"{i}\t{b64}")
-    with open(cache_file, 'w') as f:
-        f.write('\n'.join(lines))
-
-class OroioHandler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, oroio_dir=None, dk_path=None, **kwargs):
         self.oroio_dir = oroio_dir
         self.dk_path = dk_path
         self.keys_file = os.path.join(oroio_dir, 'keys.enc')
         self.current_file = os.path.join(oroio_dir, 'current')
         self.cache_file = os.path.join(oroio_dir, 'list_cache.b64')
+        self.usage_cache = get_usage_cache(oroio_dir)
+        self.poller = get_usage_poller(oroio_dir)
         super().__init__(*args, **kwargs)
     
     def _check_auth(self) -> bool:
@@ -215,41 +2651,187 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
         token = self.headers.get('X-Auth-Token', '')
         return token in VALID_TOKENS
     
+    def _is_local(self) -> bool:
+        return self.client_address[0] in ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
     def _send_unauthorized(self):
         """Send 401 Unauthorized response"""
+        body = json.dumps({'error': 'Unauthorized'}).encode('utf-8')
         self.send_response(401)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
         self.end_headers()
-        self.wfile.write(json.dumps({'error': 'Unauthorized'}).encode('utf-8'))
-    
-    def _invalidate_cache(self):
-        """删除缓存文件"""
-        try:
-            if os.path.exists(self.cache_file):
-                os.remove(self.cache_file)
-        except:
-            pass
+        self.wfile.write(body)
     
     def _get_current_index(self) -> int:
+        return read_current_index(self.oroio_dir)
+    
+    def _set_current_index(self, idx: int):
+        write_current_index(self.oroio_dir, idx)
+    
+    def _parse_request(self):
+        """解析路径与参数：GET 取查询串，POST 取 JSON body"""
+        from urllib.parse import parse_qsl
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        if self.command == 'GET':
+            return path, dict(parse_qsl(parts.query))
+        with trace_phase('read_body'):
+            try:
+                body = read_request_body(self.rfile, self.headers).decode('utf-8')
+            except ValueError:
+                # body 边界无法确定：按空 body 处理，响应后关闭连接，避免残留数据被当作下一个请求
+                body = ''
+                self.close_connection = True
+        if self.headers.get('Content-Type', '').startswith('text/plain'):
+            # 纯文本 body（如批量导入的 key 列表）原样放入 text，查询串参数一并合入
+            from urllib.parse import parse_qsl
+            return path, {**dict(parse_qsl(parts.query)), 'text': body}
         try:
-            with open(self.current_file, 'r') as f:
-                return max(1, int(f.read().strip()))
+            with trace_phase('parse'):
+                data = json.loads(body) if body else {}
         except:
-            return 1
+            data = {}
+        return path, data
     
-    def _set_current_index(self, idx: int):
-        with open(self.current_file, 'w') as f:
-            f.write(str(idx))
+    def _dispatch(self) -> bool:
+        """按 ROUTES 分发 API 请求，未注册的路径返回 False"""
+        path, data = self._parse_request()
+        entry = ROUTES.get((self.command, path))
+        if entry is None:
+            return False
+        handler, opts = entry
+        self._route = path
+        if opts['auth'] and not self._check_auth() and not (opts['local'] and self._is_local()):
+            self._send_unauthorized()
+            return True
+        handler(self, data)
+        return True
     
+    def handle_one_request(self):
+        self._served = getattr(self, '_served', 0) + 1
+        self._close_sent = False
+        super().handle_one_request()
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+        if KEEPALIVE_MAX and self._served >= KEEPALIVE_MAX and not self.close_connection:
+            # 达到单连接请求上限：本次响应后关闭，并告知客户端
+            self.send_header('Connection', 'close')
+            self._close_sent = True
+
+    def send_error(self, code, message=None, explain=None):
+        """与父类相同的错误页，但对可安全复用连接的错误不附带 Connection: close"""
+        from http import HTTPStatus
+        try:
+            short, long = self.responses[code]
+        except KeyError:
+            short, long = '???', '???'
+        message = message or short
+        explain = explain or long
+        keep = KEEPALIVE and code in KEEPALIVE_ERROR_CODES and getattr(self, 'command', None) in ('GET', 'HEAD', 'POST')
+        self.log_error('code %d, message %s', code, message)
+        self.send_response(code, message)
+        if not keep and not self._close_sent:
+            self.send_header('Connection', 'close')
+        body = None
+        if code >= 200 and code not in (HTTPStatus.NO_CONTENT, HTTPStatus.RESET_CONTENT, HTTPStatus.NOT_MODIFIED):
+            import html
+            content = self.error_message_format % {
+                'code': code,
+                'message': html.escape(message, quote=False),
+                'explain': html.escape(explain, quote=False),
+            }
+            body = content.encode('UTF-8', 'replace')
+            self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', len(body) if body else 0)
+        self.end_headers()
+        if self.command != 'HEAD' and body:
+            self.wfile.write(body)
+
+    def setup(self):
+        super().setup()
+        if TRACING:
+            self.wfile = _TracedWriter(self.wfile)
+
+    def _observe(self):
+        """按路由统计请求数与耗时；路由标签只取注册路径或固定分类，避免基数膨胀。
+        开启追踪时同时记录分阶段耗时，写入访问日志 / 慢请求日志"""
+        import contextlib
+        import time
+
+        @contextlib.contextmanager
+        def observer():
+            self._route, self._status = None, None
+            started = time.perf_counter()
+            trace = None
+            if TRACING:
+                trace = _TRACE.current = RequestTrace()
+                if SLOW_WATCHDOG is not None:
+                    SLOW_WATCHDOG.track(trace)
+            try:
+                yield
+            finally:
+                route_label = self._route
+                if route_label is None:
+                    if self.command != 'GET':
+                        route_label = 'unmatched'
+                    elif urlsplit(self.path).path.startswith('/data/'):
+                        route_label = '/data'
+                    else:
+                        route_label = 'static'
+                METRICS.inc('oroio_http_requests_total', {
+                    'route': route_label, 'method': self.command, 'status': str(self._status or 0)})
+                elapsed = time.perf_counter() - started
+                # SSE 长连接的耗时没有意义
+                if route_label != '/api/events':
+                    METRICS.observe('oroio_http_request_seconds', elapsed, {'route': route_label})
+                if trace is not None:
+                    _TRACE.current = None
+                    if SLOW_WATCHDOG is not None:
+                        SLOW_WATCHDOG.untrack(trace)
+                    self._log_trace(trace, route_label, elapsed)
+        return observer()
+
+    def _log_trace(self, trace: RequestTrace, route_label: str, elapsed: float):
+        slow = SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS and route_label != '/api/events'
+        if not (ACCESS_LOG or slow):
+            return
+        import time
+        entry = {
+            'ts': round(time.time(), 3),
+            'method': self.command,
+            # 不记录查询串（SSE 的 token 在其中）
+            'path': urlsplit(self.path).path,
+            'route': route_label,
+            'status': self._status,
+            'ms': round(elapsed * 1000, 2),
+            'bytes': trace.bytes,
+            'client': self.client_address[0],
+            'phases': {k: round(v * 1000, 2) for k, v in trace.phases.items()},
+        }
+        if slow:
+            entry['slow'] = True
+            if trace.stack:
+                entry['stack'] = trace.stack
+        try:
+            get_access_log(self.oroio_dir).info(json.dumps(entry, ensure_ascii=False))
+        except OSError:
+            pass
+
     def do_GET(self):
-        path = unquote(self.path)
-        if path.startswith('/data/'):
-            self.serve_oroio_file(path[6:])
-        else:
-            self.serve_static_with_etag(path)
+        with self._observe():
+            path = unquote(self.path)
+            if self._dispatch():
+                return
+            if path.startswith('/data/'):
+                self.serve_oroio_file(path[6:])
+            else:
+                self.serve_static_with_etag(path)
     
     def serve_static_with_etag(self, path):
-        """Serve static files with ETag support"""
+        """Serve static files from the asset cache (br/gzip variants, content-hash ETag)"""
         filepath = self.translate_path(self.path)
         if os.path.isdir(filepath):
             # 与 SimpleHTTPRequestHandler 保持一致：目录请求缺少尾斜杠时先 301，确保后续相对资源以目录为基准解析
@@ -258,6 +2840,7 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
                 new_path = parsed._replace(path=parsed.path + '/')
                 self.send_response(301)
                 self.send_header('Location', urlunsplit(new_path))
+                self.send_header('Content-Length', 0)
                 self.end_headers()
                 return
             filepath = os.path.join(filepath, 'index.html')
@@ -266,109 +2849,56 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
             return
         
         try:
-            stat = os.stat(filepath)
-            etag = f'"{stat.st_size}-{int(stat.st_mtime)}"'
-            
-            if_none_match = self.headers.get('If-None-Match')
-            if if_none_match == etag:
-                self.send_response(304)
-                self.send_header('ETag', etag)
-                self.end_headers()
-                return
-            
-            with open(filepath, 'rb') as f:
-                content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', self.guess_type(filepath))
-            self.send_header('Content-Length', len(content))
-            self.send_header('ETag', etag)
-            self.send_header('Cache-Control', 'no-cache')
-            self.end_headers()
-            self.wfile.write(content)
-        except Exception:
+            entry = STATIC_CACHE.get(filepath, self.guess_type(filepath))
+        except OSError:
+            entry = None
+        if entry is None:
             super().do_GET()
-    
-    def do_POST(self):
-        path = unquote(self.path)
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length).decode('utf-8') if content_length > 0 else ''
-        
-        try:
-            data = json.loads(body) if body else {}
-        except:
-            data = {}
-        
-        # Auth endpoints (no auth required)
-        if path == '/api/auth':
-            self.handle_auth(data)
-            return
-        elif path == '/api/auth/check':
-            self.handle_auth_check()
             return
         
-        # All other endpoints require auth
-        if not self._check_auth():
-            self._send_unauthorized()
+        encoding, body = STATIC_CACHE.select(entry, accepted_encodings(self.headers.get('Accept-Encoding')))
+        # 不同编码是不同表示，ETag 需区分
+        etag = f'"{entry["etag"]}-{encoding}"' if encoding else f'"{entry["etag"]}"'
+        if urlsplit(self.path).path.startswith('/assets/'):
+            cache_control = STATIC_IMMUTABLE
+        else:
+            cache_control = 'no-cache'
+        
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Vary', 'Accept-Encoding')
+            # 304 的 Content-Length 必须与对应 200 响应一致
+            self.send_header('Content-Length', len(body) if body is not None else entry['size'])
+            self.end_headers()
             return
         
-        if path == '/api/add':
-            self.handle_add_key(data)
-        elif path == '/api/remove':
-            self.handle_remove_key(data)
-        elif path == '/api/use':
-            self.handle_use_key(data)
-        elif path == '/api/refresh':
-            self.handle_refresh()
-        # Skills
-        elif path == '/api/skills/list':
-            self.handle_list_skills()
-        elif path == '/api/skills/create':
-            self.handle_create_skill(data)
-        elif path == '/api/skills/delete':
-            self.handle_delete_skill(data)
-        # Commands
-        elif path == '/api/commands/list':
-            self.handle_list_commands()
-        elif path == '/api/commands/create':
-            self.handle_create_command(data)
-        elif path == '/api/commands/delete':
-            self.handle_delete_command(data)
-        elif path == '/api/commands/content':
-            self.handle_command_content(data)
-        elif path == '/api/commands/update':
-            self.handle_update_command(data)
-        elif path == '/api/commands/rename':
-            self.handle_rename_command(data)
-        # Droids
-        elif path == '/api/droids/list':
-            self.handle_list_droids()
-        elif path == '/api/droids/create':
-            self.handle_create_droid(data)
-        elif path == '/api/droids/delete':
-            self.handle_delete_droid(data)
-        # MCP
-        elif path == '/api/mcp/list':
-            self.handle_list_mcp()
-        elif path == '/api/mcp/add':
-            self.handle_add_mcp(data)
-        elif path == '/api/mcp/remove':
-            self.handle_remove_mcp(data)
-        elif path == '/api/mcp/update':
-            self.handle_update_mcp(data)
-        # BYOK (Custom Models)
-        elif path == '/api/byok/list':
-            self.handle_list_byok()
-        elif path == '/api/byok/remove':
-            self.handle_remove_byok(data)
-        elif path == '/api/byok/update':
-            self.handle_update_byok(data)
-        # DK config
-        elif path == '/api/dk/config':
-            self.handle_dk_config(data)
+        self.send_response(200)
+        self.send_header('Content-Type', entry['type'])
+        self.send_header('Content-Length', len(body) if body is not None else entry['size'])
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
         else:
-            self.send_error(404, 'Not Found')
+            # 大文件交给内核 sendfile，不经过 Python 缓冲
+            with open(filepath, 'rb') as f:
+                self.wfile.flush()
+                with trace_phase('respond'):
+                    self.connection.sendfile(f, 0, entry['size'])
     
+    def do_POST(self):
+        with self._observe():
+            if not self._dispatch():
+                self.send_error(404, 'Not Found')
+    
+    @route('/api/auth', auth=False)
     def handle_auth(self, data):
         """Handle PIN authentication"""
         global PIN_HASH, VALID_TOKENS
@@ -390,7 +2920,8 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
         else:
             self.send_json({'success': False, 'error': 'Invalid PIN'})
     
-    def handle_auth_check(self):
+    @route('/api/auth/check', methods=('GET', 'POST'), auth=False)
+    def handle_auth_check(self, data):
         """Check if PIN is required and if current token is valid"""
         global PIN_HASH
         if PIN_HASH is None:
@@ -412,6 +2943,20 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
         
         filepath = os.path.join(self.oroio_dir, filename)
         
+        if filename == 'list_cache.b64':
+            # 优先使用内存中的最新导出，避免读盘
+            content = self.usage_cache.legacy_body(self.keys_file, self.cache_file)
+            if content is not None:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', len(content))
+                self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+                self.send_header('Pragma', 'no-cache')
+                self.send_header('Expires', '0')
+                self.end_headers()
+                self.wfile.write(content)
+                return
+        
         if not os.path.isfile(filepath):
             if filename == 'list_cache.b64':
                 # 首次启动缓存可能不存在，返回空内容避免 404 噪声
@@ -442,106 +2987,412 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_error(500, str(e))
     
+    @route('/api/add')
     def handle_add_key(self, data):
         key = data.get('key', '').strip()
         if not key:
             self.send_json({'success': False, 'error': 'Key is required'})
             return
         try:
-            keys = decrypt_keys(self.keys_file)
-            keys.append(key)
-            encrypt_keys(keys, self.keys_file)
-            self._invalidate_cache()
+            with KEYS_WRITE_LOCK:
+                keys = decrypt_keys(self.keys_file)
+                if key in keys:
+                    self.send_json({'success': False, 'error': '该 key 已存在'})
+                    return
+                keys.append(key)
+                encrypt_keys(keys, self.keys_file)
+            # 只获取新 key 的用量，其余条目保持不变
+            refresh_usage_cache(self.usage_cache, self.keys_file, self.cache_file, keys, only=[key])
             self.send_json({'success': True, 'message': f'已添加。当前共有 {len(keys)} 个key。'})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/remove')
     def handle_remove_key(self, data):
-        index = data.get('index')
-        if not index:
+        """按 id（优先）或序号删除；current 继续指向原来的 key"""
+        if not data.get('id') and not data.get('index'):
+            self.send_json({'success': False, 'error': 'Index is required'})
+            return
+        try:
+            with KEYS_WRITE_LOCK:
+                records = read_key_records(self.keys_file)
+                idx, record = find_key_record(records, data.get('id'), data.get('index'))
+                if record is None:
+                    self.send_json({'success': False, 'error': '序号超出范围'})
+                    return
+                current = self._get_current_index()
+                current_id = records[current - 1]['id'] if current <= len(records) else None
+                records.pop(idx - 1)
+                write_key_records(records, self.keys_file)
+            new_current, _ = find_key_record(records, current_id) if current_id != record['id'] else (None, None)
+            if new_current is None:
+                new_current = max(1, min(idx, len(records)))
+            if new_current != current:
+                self._set_current_index(new_current)
+            keys = [r['key'] for r in records]
+            # 无需重新获取：丢弃被删 key 的条目并按新顺序重新导出
+            refresh_usage_cache(self.usage_cache, self.keys_file, self.cache_file, keys, only=[])
+            self.send_json({'success': True, 'message': f'已删除，剩余 {len(keys)} 个key。', 'current': new_current})
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+    
+    @route('/api/keys/update')
+    def handle_update_key(self, data):
+        """修改 key 的元数据：{id | index, label?, tags?}"""
+        try:
+            with KEYS_WRITE_LOCK:
+                records = read_key_records(self.keys_file)
+                idx, record = find_key_record(records, data.get('id'), data.get('index'))
+                if record is None:
+                    self.send_json({'success': False, 'error': 'Key not found'})
+                    return
+                if 'label' in data:
+                    record['label'] = ' '.join(str(data['label'] or '').split())
+                if 'tags' in data:
+                    tags = data['tags'] or []
+                    if isinstance(tags, str):
+                        tags = tags.split(',')
+                    record['tags'] = [t for t in (' '.join(str(t).split()) for t in tags) if t]
+                write_key_records(records, self.keys_file)
+            self.send_json({'success': True, 'key': key_record_info(record, idx)})
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+    
+    @route('/api/keys/import')
+    def handle_import_keys(self, data):
+        """批量导入：{keys: [...]} 或 {text: "..."}（也可直接 POST text/plain）。
+        validate=true 时并发校验新 key，并以 NDJSON 流式返回每个 key 的结果，最后一行为汇总"""
+        candidates = data.get('keys')
+        if not isinstance(candidates, list):
+            candidates = parse_key_text(str(data.get('text', '')))
+        candidates = [str(k) for k in candidates]
+        if not candidates:
+            self.send_json({'success': False, 'error': 'Keys are required'})
+            return
+        validate = str(data.get('validate', '')).lower() in ('1', 'true')
+        keep_invalid = str(data.get('keepInvalid', '')).lower() in ('1', 'true')
+        if not validate:
+            try:
+                result = import_keys(self.oroio_dir, candidates)
+                if result['added']:
+                    self.poller.trigger()
+                self.send_json({'success': True, **result})
+            except Exception as e:
+                self.send_json({'success': False, 'error': str(e)})
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        # 流式输出没有 Content-Length，以关闭连接结束响应
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        
+        def emit(event):
+            self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        
+        try:
+            result = import_keys(self.oroio_dir, candidates, validate=True,
+                                 keep_invalid=keep_invalid, progress=emit)
+            emit({'type': 'done', 'success': True, **result})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            try:
+                emit({'type': 'done', 'success': False, 'error': str(e)})
+            except OSError:
+                pass
+    
+    @route('/api/keys/export', methods=('GET', 'POST'))
+    def handle_export_keys(self, data):
+        """导出全部 key，每行一个（与 dk add --file / /api/keys/import 的输入格式相同）"""
+        try:
+            body = ''.join(f'{k}\n' for k in decrypt_keys(self.keys_file)).encode('utf-8')
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.send_header('Content-Disposition', 'attachment; filename="oroio-keys.txt"')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    @route('/api/use')
+    def handle_use_key(self, data):
+        if not data.get('id') and not data.get('index'):
             self.send_json({'success': False, 'error': 'Index is required'})
             return
         try:
-            idx = int(index)
+            idx, record = find_key_record(read_key_records(self.keys_file), data.get('id'), data.get('index'))
+            if record is None:
+                self.send_json({'success': False, 'error': '序号超出范围'})
+                return
+            self._set_current_index(idx)
+            self.send_json({'success': True, 'message': f'已切换到序号 {idx}', 'index': idx, 'id': record['id']})
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+    
+    @route('/api/refresh')
+    def handle_refresh(self, data):
+        """触发后台刷新并立即返回；传 wait=true 时等待本轮完成（最多 API_TIMEOUT * API_RETRIES 秒）"""
+        try:
+            target = self.poller.trigger(force=bool(data.get('force')))
+            if data.get('wait'):
+                with trace_phase('upstream'):
+                    done = self.poller.wait(target, timeout=API_TIMEOUT * API_RETRIES)
+                self.send_json({'success': True, 'done': done})
+            else:
+                self.send_json({'success': True, 'queued': True})
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+
+    @route('/api/events', methods=('GET',), auth=False)
+    def handle_events(self, data):
+        """SSE：推送 usage / current / keys / config 增量。EventSource 无法带自定义头，token 走查询参数"""
+        import queue
+        from urllib.parse import parse_qs
+        token = parse_qs(urlsplit(self.path).query).get('token', [''])[0]
+        if PIN_HASH is not None and token not in VALID_TOKENS and not self._check_auth():
+            self._send_unauthorized()
+            return
+        if EVENTS.subscriber_count() >= SSE_MAX_STREAMS:
+            self._send_busy()
+            return
+        q = EVENTS.subscribe()
+        get_file_watcher(self.oroio_dir).start()
+        detach = getattr(self.server, 'detach', None)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+            self._write_event('current', {'index': self._get_current_index()})
+            if detach is not None:
+                # 长连接交给独立线程推送，worker 立即回到线程池
+                detach(self.request, lambda sock: _pump_events(sock, q))
+                q = None
+                return
+            while True:
+                try:
+                    event, data = q.get(timeout=SSE_PING_INTERVAL)
+                    self._write_event(event, data)
+                except queue.Empty:
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            if q is not None:
+                EVENTS.unsubscribe(q)
+            self.close_connection = True
+
+    def _send_busy(self):
+        body = json.dumps({'error': 'Server busy'}).encode('utf-8')
+        self.send_response(503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_event(self, event: str, data: dict):
+        self.wfile.write(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    @route('/api/rotate', local=True)
+    def handle_rotate(self, data):
+        """预测式轮换：返回应使用的 key 序号（不返回 key 本身），apply=false 时只做评估"""
+        try:
             keys = decrypt_keys(self.keys_file)
-            if idx < 1 or idx > len(keys):
-                self.send_json({'success': False, 'error': '序号超出范围'})
+            if not keys:
+                self.send_json({'success': False, 'error': 'No keys'})
                 return
-            keys.pop(idx - 1)
-            encrypt_keys(keys, self.keys_file)
-            self._set_current_index(1)
-            self._invalidate_cache()
-            self.send_json({'success': True, 'message': f'已删除，剩余 {len(keys)} 个key。'})
-        except Exception as e:
-            self.send_json({'success': False, 'error': str(e)})
-    
-    def handle_use_key(self, data):
-        index = data.get('index')
-        if not index:
-            self.send_json({'success': False, 'error': 'Index is required'})
-            return
-        try:
-            idx = int(index)
-            keys = decrypt_keys(self.keys_file)
-            if idx < 1 or idx > len(keys):
-                self.send_json({'success': False, 'error': '序号超出范围'})
+            decision = choose_key(self.usage_cache, keys, self._get_current_index())
+            if decision['index'] is None:
+                self.send_json({'success': False, 'error': decision['reason']})
                 return
-            self._set_current_index(idx)
-            self.send_json({'success': True, 'message': f'已切换到序号 {idx}'})
+            if decision['rotated'] and data.get('apply', True):
+                self._set_current_index(decision['index'])
+            decision['id'] = _cached_key_records(self.keys_file)[decision['index'] - 1]['id']
+            # 当前 key 的数据已过期时，后台补一次刷新以便下次决策更准确
+            if self.usage_cache.stale_keys([keys[decision['index'] - 1]]):
+                self.poller.trigger()
+            # runway 可能为 inf（无过期时间且无燃烧速率），JSON 中用 null 表示
+            decision = {k: (None if v == float('inf') else v) for k, v in decision.items()}
+            self.send_json({'success': True, **decision})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
-    
-    def handle_refresh(self):
+
+    @route('/api/history', methods=('GET', 'POST'))
+    def handle_history(self, data):
+        """用量历史：{from, to, id? | index?}，返回每个 key 的 [ts, used, total] 序列（按序号），ids 为序号到 id 的映射"""
+        import time
         try:
-            keys = decrypt_keys(self.keys_file)
-            if not keys:
-                self.send_json({'success': True})
-                return
-            usages = fetch_all_usages(keys)
-            write_cache(self.keys_file, self.cache_file, keys, usages)
-            self.send_json({'success': True})
+            now = time.time()
+            start = float(data.get('from', now - 7 * 86400))
+            end = float(data.get('to', now + 1))
+            records = read_key_records(self.keys_file)
+            keys = [r['key'] for r in records]
+            fp_to_index = {}
+            for i, key in enumerate(keys):
+                fp_to_index.setdefault(self.usage_cache.fingerprint(key), i + 1)
+            if data.get('id') or data.get('index'):
+                idx, record = find_key_record(records, data.get('id'), data.get('index'))
+                if record is None:
+                    self.send_json({'success': False, 'error': '序号超出范围'})
+                    return
+                key_ids = {self.usage_cache.fingerprint(record['key'])}
+            else:
+                key_ids = set(fp_to_index)
+            series = {}
+            for ts, kid, used, total in get_usage_history(self.oroio_dir).query(start, end, key_ids):
+                series.setdefault(str(fp_to_index[kid]), []).append([ts, used, total])
+            ids = {idx: records[int(idx) - 1]['id'] for idx in series}
+            self.send_json({'success': True, 'from': start, 'to': end, 'series': series, 'ids': ids})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
+
+    @route('/api/usage', methods=('GET', 'POST'))
+    def handle_usage(self, data):
+        """从内存返回所有 key 的用量与各自的获取时间，不访问上游"""
+        import time
+        records = read_key_records(self.keys_file)
+        cur = self._get_current_index()
+        now = time.time()
+        items, oldest = [], None
+        for i, record in enumerate(records):
+            entry = self.usage_cache.entry(record['key'])
+            item = {**key_record_info(record, i + 1), 'isCurrent': i + 1 == cur,
+                    'usage': None, 'fetchedAt': None, 'stale': True}
+            if entry:
+                item.update(usage=entry['usage'], fetchedAt=entry['ts'], stale=now - entry['ts'] >= entry['ttl'])
+                oldest = entry['ts'] if oldest is None else min(oldest, entry['ts'])
+            items.append(item)
+        self.send_json({
+            'keys': items,
+            'current': cur,
+            'updatedAt': oldest,
+            'lastPoll': self.poller.last_poll,
+            'refreshing': self.poller.refreshing,
+            'now': now,
+        })
     
-    def send_json(self, data):
-        body = json.dumps(data).encode('utf-8')
+    @route('/metrics', methods=('GET',), local=True)
+    def handle_metrics(self, data):
+        """Prometheus 文本格式导出；key 级指标只带序号和 id，不含 key 本身"""
+        import time
+        now = time.time()
+        records = read_key_records(self.keys_file)
+        gauges = [
+            ('oroio_keys', {}, len(records)),
+            ('oroio_current_key_index', {}, self._get_current_index()),
+            ('oroio_sse_subscribers', {}, EVENTS.subscriber_count()),
+        ]
+        pool_stats = getattr(self.server, 'pool_stats', None)
+        if pool_stats is not None:
+            stats = pool_stats()
+            gauges += [('oroio_http_workers', {}, stats['workers']),
+                       ('oroio_http_workers_busy', {}, stats['busy']),
+                       ('oroio_http_queue_depth', {}, stats['queued'])]
+        if self.poller.last_poll:
+            gauges.append(('oroio_poll_last_timestamp_seconds', {}, self.poller.last_poll))
+        for i, record in enumerate(records):
+            entry = self.usage_cache.entry(record['key'])
+            if not entry or not entry.get('usage'):
+                continue
+            usage = entry['usage']
+            labels = {'index': str(i + 1), 'id': record['id']}
+            gauges.append(('oroio_key_usage_age_seconds', labels, max(0.0, now - entry['ts'])))
+            try:
+                balance = float(usage.get('BALANCE_NUM'))
+                total = float(usage.get('TOTAL'))
+            except (TypeError, ValueError):
+                continue
+            gauges.append(('oroio_key_balance', labels, balance))
+            gauges.append(('oroio_key_total', labels, total))
+            if total > 0:
+                gauges.append(('oroio_key_remaining_ratio', labels, max(0.0, balance) / total))
+        body = METRICS.render(gauges).encode('utf-8')
         self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        if self.command == 'GET' and status == 200:
+            # 只读 GET 接口支持条件请求：内容未变时返回 304
+            etag = f'W/"{hashlib.sha1(body).hexdigest()[:16]}"'
+            if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Content-Length', len(body))
+                self.end_headers()
+                return
+        self.send_response(status)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Content-Length', len(body))
+        if self.command == 'GET' and status == 200:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
         self.end_headers()
         self.wfile.write(body)
     
+    @route('/api/search', methods=('GET', 'POST'))
+    def handle_search(self, data):
+        """全文搜索 commands / droids / skills：{q, kind?, limit?}"""
+        import time
+        query = str(data.get('q', '')).strip()
+        if not query:
+            self.send_json({'success': False, 'error': 'Query is required'})
+            return
+        kinds = data.get('kind') or None
+        if isinstance(kinds, str):
+            kinds = set(kinds.split(','))
+        try:
+            limit = max(1, min(int(data.get('limit', 20)), 200))
+            started = time.perf_counter()
+            result = SEARCH_INDEX.search(query, kinds, limit)
+            result.update({'success': True, 'query': query,
+                           'tookMs': round((time.perf_counter() - started) * 1000, 2)})
+            self.send_json(result)
+        except Exception as e:
+            self.send_json({'success': False, 'error': str(e)})
+    
     # Skills handlers
-    def handle_list_skills(self):
-        skills_dir = os.path.join(FACTORY_DIR, 'skills')
-        skills = []
-        try:
-            real_dir = os.path.realpath(skills_dir)
-            for entry in os.listdir(real_dir):
-                entry_path = os.path.join(real_dir, entry)
-                if os.path.isdir(entry_path):
-                    skill_file = os.path.join(entry_path, 'SKILL.md')
-                    if os.path.isfile(skill_file):
-                        skills.append({'name': entry, 'path': skill_file})
-        except:
-            pass
-        self.send_json(skills)
+    @route('/api/skills/list', methods=('GET', 'POST'))
+    def handle_list_skills(self, data):
+        self.send_json(SKILL_CATALOG.list())
     
+    @route('/api/skills/create')
     def handle_create_skill(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            skill_dir = os.path.join(FACTORY_DIR, 'skills', name)
+            skill_dir = os.path.join(FACTORY_PATHS.skills, name)
             os.makedirs(skill_dir, exist_ok=True)
             skill_file = os.path.join(skill_dir, 'SKILL.md')
             with open(skill_file, 'w') as f:
                 f.write(f'# {name}\n\nDescribe your skill instructions here.\n')
+            SKILL_CATALOG.invalidate()
+            SEARCH_INDEX.reindex('skill', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/skills/delete')
     def handle_delete_skill(self, data):
         name = data.get('name', '').strip()
         if not name:
@@ -549,87 +3400,67 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
             return
         try:
             import shutil
-            skill_dir = os.path.join(FACTORY_DIR, 'skills', name)
+            skill_dir = os.path.join(FACTORY_PATHS.skills, name)
             shutil.rmtree(skill_dir)
+            SKILL_CATALOG.invalidate()
+            SEARCH_INDEX.remove('skill', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
     # Commands handlers
-    def _parse_frontmatter(self, content):
-        """解析 frontmatter 中的 description"""
-        import re
-        match = re.match(r'^---\s*\n([\s\S]*?)\n---', content)
-        if match:
-            for line in match.group(1).split('\n'):
-                if line.startswith('description:'):
-                    return line[12:].strip()
-        return None
-
-    def handle_list_commands(self):
-        commands_dir = os.path.join(FACTORY_DIR, 'commands')
-        commands = []
-        try:
-            real_dir = os.path.realpath(commands_dir)
-            for entry in os.listdir(real_dir):
-                if entry.endswith('.md'):
-                    full_path = os.path.join(real_dir, entry)
-                    if os.path.isfile(full_path):
-                        with open(full_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        desc = self._parse_frontmatter(content)
-                        commands.append({
-                            'name': entry[:-3],
-                            'path': full_path,
-                            'description': desc,
-                            'content': content
-                        })
-        except:
-            pass
-        commands.sort(key=lambda x: x['name'].lower())
-        self.send_json(commands)
+    @route('/api/commands/list', methods=('GET', 'POST'))
+    def handle_list_commands(self, data):
+        """仅返回元数据，正文通过 /api/commands/content 按需获取"""
+        self.send_json(COMMAND_CATALOG.list())
     
+    @route('/api/commands/create')
     def handle_create_command(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            commands_dir = os.path.join(FACTORY_DIR, 'commands')
-            os.makedirs(commands_dir, exist_ok=True)
-            cmd_file = os.path.join(commands_dir, f'{name}.md')
+            os.makedirs(FACTORY_PATHS.commands, exist_ok=True)
+            cmd_file = os.path.join(FACTORY_PATHS.commands, f'{name}.md')
             with open(cmd_file, 'w') as f:
                 f.write(f'# /{name}\n\nCommand instructions here.\n')
+            COMMAND_CATALOG.invalidate()
+            SEARCH_INDEX.reindex('command', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/commands/delete')
     def handle_delete_command(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            cmd_file = os.path.join(FACTORY_DIR, 'commands', f'{name}.md')
+            cmd_file = os.path.join(FACTORY_PATHS.commands, f'{name}.md')
             os.remove(cmd_file)
+            COMMAND_CATALOG.invalidate()
+            SEARCH_INDEX.remove('command', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/commands/content')
     def handle_command_content(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'error': 'Name is required'})
             return
         try:
-            commands_dir = os.path.join(FACTORY_DIR, 'commands')
-            real_dir = os.path.realpath(commands_dir)
+            real_dir = FACTORY_PATHS.commands
             with open(os.path.join(real_dir, f'{name}.md'), 'r', encoding='utf-8') as f:
                 content = f.read()
             self.send_json({'content': content})
         except Exception as e:
             self.send_json({'error': str(e)})
     
+    @route('/api/commands/update')
     def handle_update_command(self, data):
         name = data.get('name', '').strip()
         content = data.get('content', '')
@@ -637,14 +3468,15 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            commands_dir = os.path.join(FACTORY_DIR, 'commands')
-            real_dir = os.path.realpath(commands_dir)
+            real_dir = FACTORY_PATHS.commands
             with open(os.path.join(real_dir, f'{name}.md'), 'w', encoding='utf-8') as f:
                 f.write(content)
+            SEARCH_INDEX.reindex('command', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/commands/rename')
     def handle_rename_command(self, data):
         old_name = data.get('oldName', '').strip()
         new_name = data.get('newName', '').strip()
@@ -655,206 +3487,144 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json({'success': True})
             return
         try:
-            commands_dir = os.path.join(FACTORY_DIR, 'commands')
-            real_dir = os.path.realpath(commands_dir)
+            real_dir = FACTORY_PATHS.commands
             old_path = os.path.join(real_dir, f'{old_name}.md')
             new_path = os.path.join(real_dir, f'{new_name}.md')
             if os.path.exists(new_path):
                 self.send_json({'success': False, 'error': f'Command "{new_name}" already exists'})
                 return
             os.rename(old_path, new_path)
+            COMMAND_CATALOG.invalidate()
+            SEARCH_INDEX.remove('command', old_name)
+            SEARCH_INDEX.reindex('command', new_name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
     # Droids handlers
-    def handle_list_droids(self):
-        droids_dir = os.path.join(FACTORY_DIR, 'droids')
-        droids = []
-        try:
-            real_dir = os.path.realpath(droids_dir)
-            for entry in os.listdir(real_dir):
-                if entry.endswith('.md'):
-                    full_path = os.path.join(real_dir, entry)
-                    if os.path.isfile(full_path):
-                        droids.append({'name': entry[:-3], 'path': full_path})
-        except:
-            pass
-        self.send_json(droids)
+    @route('/api/droids/list', methods=('GET', 'POST'))
+    def handle_list_droids(self, data):
+        self.send_json(DROID_CATALOG.list())
     
+    @route('/api/droids/create')
     def handle_create_droid(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            droids_dir = os.path.join(FACTORY_DIR, 'droids')
-            os.makedirs(droids_dir, exist_ok=True)
-            droid_file = os.path.join(droids_dir, f'{name}.md')
+            os.makedirs(FACTORY_PATHS.droids, exist_ok=True)
+            droid_file = os.path.join(FACTORY_PATHS.droids, f'{name}.md')
             with open(droid_file, 'w') as f:
                 f.write(f'---\nname: {name}\ndescription: A custom droid\n---\n\n# {name}\n\nDroid instructions here.\n')
+            DROID_CATALOG.invalidate()
+            SEARCH_INDEX.reindex('droid', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/droids/delete')
     def handle_delete_droid(self, data):
         name = data.get('name', '').strip()
         if not name:
             self.send_json({'success': False, 'error': 'Name is required'})
             return
         try:
-            droid_file = os.path.join(FACTORY_DIR, 'droids', f'{name}.md')
+            droid_file = os.path.join(FACTORY_PATHS.droids, f'{name}.md')
             os.remove(droid_file)
+            DROID_CATALOG.invalidate()
+            SEARCH_INDEX.remove('droid', name)
             self.send_json({'success': True})
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
     # MCP handlers
-    def handle_list_mcp(self):
-        mcp_file = os.path.join(FACTORY_DIR, 'mcp.json')
-        servers = []
-        try:
-            with open(mcp_file, 'r') as f:
-                config = json.load(f)
-            if 'mcpServers' in config:
-                for name, server in config['mcpServers'].items():
-                    item = {'name': name, **server}
-                    servers.append(item)
-        except:
-            pass
+    @route('/api/mcp/list', methods=('GET', 'POST'))
+    def handle_list_mcp(self, data):
+        try:
+            config = MCP_STORE.read()
+        except ConfigFileError as e:
+            self.send_json({'success': False, 'error': str(e)}, 500)
+            return
+        servers = [{'name': name, **server} for name, server in config.get('mcpServers', {}).items()]
         self.send_json(servers)
     
-    def handle_add_mcp(self, data):
-        name = data.get('name', '').strip()
-        command = data.get('command', '').strip()
-        args = data.get('args', [])
-        if not name or not command:
-            self.send_json({'success': False, 'error': 'Name and command are required'})
-            return
+    def _apply_config_op(self, op):
+        store, apply_op = CONFIG_OPS[op['op'].split('.')[0]]
         try:
-            mcp_file = os.path.join(FACTORY_DIR, 'mcp.json')
-            config = {'mcpServers': {}}
-            try:
-                with open(mcp_file, 'r') as f:
-                    config = json.load(f)
-                if 'mcpServers' not in config:
-                    config['mcpServers'] = {}
-            except:
-                pass
-            config['mcpServers'][name] = {'command': command, 'args': args}
-            os.makedirs(FACTORY_DIR, exist_ok=True)
-            with open(mcp_file, 'w') as f:
-                json.dump(config, f, indent=2)
+            store.update(lambda config: apply_op(config, op))
             self.send_json({'success': True})
+        except ConfigFileError as e:
+            self.send_json({'success': False, 'error': str(e)}, 500)
         except Exception as e:
             self.send_json({'success': False, 'error': str(e)})
     
+    @route('/api/mcp/add')
+    def handle_add_mcp(self, data):
+        self._apply_config_op({**data, 'op': 'mcp.add'})
+    
+    @route('/api/mcp/remove')
     def handle_remove_mcp(self, data):
-        name = data.get('name', '').strip()
-        if not name:
-            self.send_json({'success': False, 'error': 'Name is required'})
-            return
-        try:
-            mcp_file = os.path.join(FACTORY_DIR, 'mcp.json')
-            with open(mcp_file, 'r') as f:
-                config = json.load(f)
-            if 'mcpServers' in config and name in config['mcpServers']:
-                del config['mcpServers'][name]
-                with open(mcp_file, 'w') as f:
-                    json.dump(config, f, indent=2)
-            self.send_json({'success': True})
-        except Exception as e:
-            self.send_json({'success': False, 'error': str(e)})
+        self._apply_config_op({**data, 'op': 'mcp.remove'})
     
+    @route('/api/mcp/update')
     def handle_update_mcp(self, data):
-        name = data.get('name', '').strip()
-        server_config = data.get('config', {})
-        if not name:
-            self.send_json({'success': False, 'error': 'Name is required'})
-            return
-        try:
-            mcp_file = os.path.join(FACTORY_DIR, 'mcp.json')
-            config = {'mcpServers': {}}
-            try:
-                with open(mcp_file, 'r') as f:
-                    config = json.load(f)
-                if 'mcpServers' not in config:
-                    config['mcpServers'] = {}
-            except:
-                pass
-            config['mcpServers'][name] = server_config
-            os.makedirs(FACTORY_DIR, exist_ok=True)
-            with open(mcp_file, 'w') as f:
-                json.dump(config, f, indent=2)
-            self.send_json({'success': True})
-        except Exception as e:
-            self.send_json({'success': False, 'error': str(e)})
+        self._apply_config_op({**data, 'op': 'mcp.update'})
     
     # BYOK (Custom Models) handlers
-    def _get_factory_config(self):
-        """Read ~/.factory/config.json"""
-        config_file = os.path.join(FACTORY_DIR, 'config.json')
+    @route('/api/byok/list', methods=('GET', 'POST'))
+    def handle_list_byok(self, data):
         try:
-            with open(config_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    
-    def _save_factory_config(self, config):
-        """Write ~/.factory/config.json"""
-        config_file = os.path.join(FACTORY_DIR, 'config.json')
-        os.makedirs(FACTORY_DIR, exist_ok=True)
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=2)
-    
-    def handle_list_byok(self):
-        config = self._get_factory_config()
-        models = config.get('custom_models', [])
-        self.send_json(models)
+            config = FACTORY_CONFIG_STORE.read()
+        except ConfigFileError as e:
+            self.send_json({'success': False, 'error': str(e)}, 500)
+            return
+        self.send_json(config.get('custom_models', []))
     
+    @route('/api/byok/remove')
     def handle_remove_byok(self, data):
-        index = data.get('index')
-        if index is None:
-            self.send_json({'success': False, 'error': 'Index is required'})
-            return
-        try:
-            config = self._get_factory_config()
-            models = config.get('custom_models', [])
-            idx = int(index)
-            if idx < 0 or idx >= len(models):
-                self.send_json({'success': False, 'error': 'Index out of range'})
-                return
-            models.pop(idx)
-            config['custom_models'] = models
-            self._save_factory_config(config)
-            self.send_json({'success': True})
-        except Exception as e:
-            self.send_json({'success': False, 'error': str(e)})
+        self._apply_config_op({**data, 'op': 'byok.remove'})
     
+    @route('/api/byok/update')
     def handle_update_byok(self, data):
-        index = data.get('index')
-        model_config = data.get('config')
-        if model_config is None:
-            self.send_json({'success': False, 'error': 'Config is required'})
+        self._apply_config_op({**data, 'op': 'byok.update'})
+    
+    @route('/api/config/batch')
+    def handle_config_batch(self, data):
+        """批量修改 mcp.json / config.json：{ops: [{op: 'mcp.add' | 'mcp.update' | 'mcp.remove' | 'byok.update' | 'byok.remove', ...}]}
+        同一文件的修改合并为一次写入；任一修改失败则该文件不做任何改动"""
+        ops = data.get('ops')
+        if not isinstance(ops, list) or not ops:
+            self.send_json({'success': False, 'error': 'ops is required'})
             return
-        try:
-            config = self._get_factory_config()
-            models = config.get('custom_models', [])
-            if index is None or int(index) < 0:
-                # Add new model (index is None or -1)
-                models.append(model_config)
-            else:
-                idx = int(index)
-                if idx >= len(models):
-                    self.send_json({'success': False, 'error': 'Index out of range'})
-                    return
-                models[idx] = model_config
-            config['custom_models'] = models
-            self._save_factory_config(config)
-            self.send_json({'success': True})
-        except Exception as e:
-            self.send_json({'success': False, 'error': str(e)})
+        groups = {}
+        for i, op in enumerate(ops):
+            prefix = str(op.get('op', '')).split('.')[0] if isinstance(op, dict) else ''
+            if prefix not in CONFIG_OPS:
+                self.send_json({'success': False, 'error': f'Unknown op at {i}'})
+                return
+            groups.setdefault(prefix, []).append(op)
+        
+        def apply_all(apply_op, group):
+            def mutate(config):
+                for op in group:
+                    apply_op(config, op)
+            return mutate
+        
+        results, status = {}, 200
+        for prefix, group in groups.items():
+            store, apply_op = CONFIG_OPS[prefix]
+            try:
+                store.update(apply_all(apply_op, group))
+                results[prefix] = {'success': True, 'applied': len(group)}
+            except ConfigFileError as e:
+                results[prefix] = {'success': False, 'error': str(e)}
+                status = 500
+            except Exception as e:
+                results[prefix] = {'success': False, 'error': str(e)}
+        self.send_json({'success': all(r['success'] for r in results.values()), 'results': results}, status)
     
+    @route('/api/dk/config')
     def handle_dk_config(self, data):
         """Get or set dk config (key=value format, same as dk CLI)"""
         config_file = os.path.join(self.oroio_dir, 'config')
@@ -902,19 +3672,752 @@ class OroioHandler(http.server.SimpleHTTPRequestHandler):
     def log_message(self, format, *args):
         pass
 
+def _pump_events(sock, q):
+    """在独立线程中向已脱离 worker 的 SSE 连接推送事件，连接断开后退订"""
+    import queue
+    sock.settimeout(SSE_PING_INTERVAL)
+    try:
+        while True:
+            try:
+                event, data = q.get(timeout=SSE_PING_INTERVAL)
+                sock.sendall(f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+            except queue.Empty:
+                sock.sendall(b': ping\n\n')
+    except OSError:
+        pass
+    finally:
+        EVENTS.unsubscribe(q)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """固定数量的 worker 线程 + 有界等待队列，取代每个连接一个线程的 ThreadingHTTPServer。
+    队列满时在 accept 线程上直接回 503 + Retry-After；SSE 等长连接通过 detach 移出线程池"""
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers: int = SERVE_WORKERS, queue_size: int = SERVE_QUEUE):
+        import queue
+        super().__init__(server_address, handler_class)
+        self.workers = max(1, workers)
+        self.pending = queue.Queue(maxsize=max(1, queue_size))
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+        self._detached = set()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'http-worker-{i}', daemon=True).start()
+
+    def overloaded(self) -> bool:
+        """所有 worker 都被占用且仍有连接在排队。只有 worker 空闲、排队只是瞬时的，不算过载，
+        否则并发建连时空闲的持久连接会被无谓关闭，客户端在其上发出的请求得不到响应"""
+        if self.pending.empty():
+            return False
+        with self._busy_lock:
+            return self.busy >= self.workers
+
+    def process_request(self, request, client_address):
+        import queue
+        import time
+        try:
+            self.pending.put_nowait((request, client_address, time.perf_counter()))
+        except queue.Full:
+            METRICS.inc('oroio_http_rejected_total')
+            self._reject(request)
+
+    def _reject(self, request):
+        body = b'{"error": "Server busy"}'
+        try:
+            # 先尽量读掉已到达的请求数据，避免直接 close 触发 RST 导致客户端看不到 503
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except OSError:
+                pass
+            request.settimeout(1)
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+                            b'Retry-After: 1\r\nConnection: close\r\n'
+                            + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        import time
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address, queued = item
+            METRICS.observe('oroio_http_queue_seconds', time.perf_counter() - queued)
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+                self.shutdown_request(request)
+
+    def detach(self, request, target):
+        """把连接交给 target(sock) 在独立线程中继续使用；worker 返回时不再关闭该连接"""
+        with self._busy_lock:
+            self._detached.add(request)
+        threading.Thread(target=target, args=(request,), name='http-detached', daemon=True).start()
+
+    def shutdown_request(self, request):
+        with self._busy_lock:
+            if request in self._detached:
+                self._detached.discard(request)
+                return
+        super().shutdown_request(request)
+
+    def pool_stats(self) -> dict:
+        with self._busy_lock:
+            busy = self.busy
+        return {'workers': self.workers, 'busy': busy, 'queued': self.pending.qsize()}
+
+    def server_close(self):
+        super().server_close()
+        for _ in range(self.workers):
+            try:
+                self.pending.put_nowait(None)
+            except Exception:
+                break
+
+PROXY_PORT = int(os.environ.get('DKM_PROXY_PORT', '7759'))
+PROXY_UPSTREAM = os.environ.get('DKM_PROXY_UPSTREAM', API_BASE_URL)
+PROXY_WORKERS = int(os.environ.get('DKM_PROXY_WORKERS', '32'))          # 同时转发的请求数（流式响应会占住 worker）
+PROXY_READ_TIMEOUT = float(os.environ.get('DKM_PROXY_READ_TIMEOUT', '300'))  # 上游两次数据之间的最长等待
+PROXY_CLIENT_IDLE = 60
+PROXY_CHUNK = 64 * 1024
+PROXY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                     'transfer-encoding', 'upgrade', 'host', 'content-length'}
+# 429 的响应体含这些词时视为额度耗尽（换 key），否则是普通限流，原样返回给客户端
+PROXY_QUOTA_HINTS = ('quota', 'insufficient', 'credit', 'balance', 'allowance', 'usage limit', 'token limit')
+
+def proxy_failure(status: int, body: bytes):
+    """上游错误是否应换 key：返回 'auth' / 'quota'，否则 None。
+    403 可能来自接口或权限而非 key 本身，原样返回给客户端，不换 key 也不记录"""
+    if status == 401:
+        return 'auth'
+    if status == 402:
+        return 'quota'
+    if status == 429:
+        text = body[:4096].decode('utf-8', 'replace').lower()
+        if any(hint in text for hint in PROXY_QUOTA_HINTS):
+            return 'quota'
+    return None
+
+class KeyRotator:
+    """代理的 key 选择：与 /api/rotate 一样基于 usage 缓存（choose_key），
+    上游返回鉴权/额度错误时把该 key 记入缓存并换下一个，current 跟随实际使用的 key"""
+    def __init__(self, oroio_dir: str):
+        self.oroio_dir = oroio_dir
+        self.keys_file = os.path.join(oroio_dir, 'keys.enc')
+        self.cache_file = os.path.join(oroio_dir, 'list_cache.b64')
+        self.cache = get_usage_cache(oroio_dir)
+
+    def _known_bad(self, key: str) -> bool:
+        entry = self.cache.entry(key)
+        return entry is not None and key_status(entry['usage']) in ('exhausted', 'invalid')
+
+    def candidates(self) -> list:
+        """按尝试顺序返回 [(序号, key)]：choose_key 的选择、当前 key，然后从当前位置往后轮询；跳过已知耗尽/无效的 key"""
+        keys = decrypt_keys(self.keys_file)
+        if not keys:
+            return []
+        current = read_current_index(self.oroio_dir)
+        if not 1 <= current <= len(keys):
+            current = 1
+        order = []
+        decision = choose_key(self.cache, keys, current)
+        if decision['index'] is not None:
+            order.append(decision['index'])
+        order += [(current - 1 + i) % len(keys) + 1 for i in range(len(keys))]
+        seen, result = set(), []
+        for idx in order:
+            if idx not in seen and not self._known_bad(keys[idx - 1]):
+                seen.add(idx)
+                result.append((idx, keys[idx - 1]))
+        # 全部已知不可用时仍用当前 key 请求一次，让客户端看到上游真实的错误
+        return result or [(current, keys[current - 1])]
+
+    def mark_failed(self, key: str, reason: str, status: int):
+        """记录上游的失败结果，格式与 AsyncUsageRefresher 的结果一致，dashboard / dk list / choose_key 都能看到"""
+        entry = self.cache.entry(key)
+        usage = dict(entry['usage']) if entry else {'BALANCE': 0, 'BALANCE_NUM': 0, 'TOTAL': 0, 'USED': 0,
+                                                    'EXPIRES': '?', 'RAW': ''}
+        if reason == 'quota':
+            # 额度耗尽：余额记为 0；总额未知时保留 TOTAL/USED 原值，而不是记成无效 key
+            usage.update(BALANCE=0, BALANCE_NUM=0, RAW='')
+            if usage.get('TOTAL', 0) > 0:
+                usage['USED'] = usage['TOTAL']
+        else:
+            usage.update(RAW=f'http_{status}', EXPIRES='Invalid key')
+        self.cache.put(key, usage)
+        try:
+            self.cache.save()
+            self.cache.export_legacy(self.keys_file, self.cache_file, decrypt_keys(self.keys_file))
+        except OSError:
+            pass
+
+    def use(self, idx: int):
+        if read_current_index(self.oroio_dir) != idx:
+            write_current_index(self.oroio_dir, idx)
+            EVENTS.publish('current', {'index': idx})
+
+class KeyProxyHandler(PooledKeepAliveMixin, http.server.BaseHTTPRequestHandler):
+    """本机反向代理：替换客户端的鉴权头为选中的 key，流式转发响应；鉴权/额度错误时换 key 重放请求"""
+    protocol_version = 'HTTP/1.1'
+    timeout = PROXY_CLIENT_IDLE
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, rotator=None, pool=None, token=None, **kwargs):
+        self.rotator = rotator
+        self.pool = pool
+        self.token = token
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self._proxy()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = do_GET
+
+    def _client_token(self) -> str:
+        auth = self.headers.get('Authorization', '')
+        if auth[:7].lower() == 'bearer ':
+            return auth[7:].strip()
+        return self.headers.get('x-api-key', '').strip()
+
+    def _reply_json(self, status: int, data: dict):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _upstream_headers(self, key: str) -> dict:
+        headers = {k: v for k, v in self.headers.items()
+                   if k.lower() not in PROXY_HOP_HEADERS and k.lower() not in ('authorization', 'x-api-key')}
+        headers['Authorization'] = f'Bearer {key}'
+        if 'x-api-key' in self.headers:
+            headers['x-api-key'] = key
+        return headers
+
+    def _send_head(self, resp, extra: dict):
+        self.send_response(resp.status, resp.reason)
+        for k, v in resp.getheaders():
+            # Server/Date 已由 send_response 写出，不再重复上游的值
+            if k.lower() not in PROXY_HOP_HEADERS and k.lower() not in ('server', 'date'):
+                self.send_header(k, v)
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def _proxy(self):
+        import hmac
+        if self.token and not hmac.compare_digest(self._client_token().encode(), self.token.encode()):
+            self._reply_json(401, {'error': 'Invalid proxy token'})
+            return
+        path = self.path
+        if '://' in path:
+            parts = urlsplit(path)
+            path = parts.path + (f'?{parts.query}' if parts.query else '')
+        try:
+            body = read_request_body(self.rfile, self.headers) or None
+        except ValueError:
+            self.close_connection = True
+            self._reply_json(400, {'error': 'Malformed chunked body'})
+            return
+        candidates = self.rotator.candidates()
+        if not candidates:
+            self._reply_json(503, {'error': 'No keys configured'})
+            return
+        for attempt, (idx, key) in enumerate(candidates):
+            try:
+                conn, resp = self.pool.open(self.command, path, self._upstream_headers(key), body)
+            except Exception as e:
+                # 网络错误与 key 无关，换 key 无意义
+                METRICS.inc('oroio_proxy_requests_total', {'status': 'error'})
+                self._reply_json(502, {'error': f'Upstream unreachable: {e}'})
+                return
+            if resp.status in (401, 402, 429):
+                data = resp.read()
+                self.pool.done(conn, resp)
+                text = data
+                if resp.getheader('Content-Encoding', '') == 'gzip':
+                    import gzip
+                    try:
+                        text = gzip.decompress(data)
+                    except OSError:
+                        pass
+                reason = proxy_failure(resp.status, text)
+                if reason:
+                    self.rotator.mark_failed(key, reason, resp.status)
+                    if attempt < len(candidates) - 1:
+                        METRICS.inc('oroio_proxy_failover_total', {'reason': reason})
+                        continue
+                METRICS.inc('oroio_proxy_requests_total', {'status': str(resp.status)})
+                self._send_head(resp, {'Content-Length': len(data)})
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+                return
+            METRICS.inc('oroio_proxy_requests_total', {'status': str(resp.status)})
+            if resp.status < 400:
+                self.rotator.use(idx)
+            self._relay(conn, resp)
+            return
+
+    def _relay(self, conn, resp):
+        """边读边写，不缓冲整个响应；长度未知时以 chunked 转发（SSE / 流式补全）"""
+        if self.command == 'HEAD' or resp.status in (204, 304) or resp.status < 200:
+            extra = {'Content-Length': resp.getheader('Content-Length')} if resp.getheader('Content-Length') else {}
+            self._send_head(resp, extra)
+            resp.read()
+            self.pool.done(conn, resp)
+            return
+        chunked = False
+        if resp.length is not None:
+            self._send_head(resp, {'Content-Length': resp.length})
+        elif self.request_version == 'HTTP/1.1':
+            chunked = True
+            self._send_head(resp, {'Transfer-Encoding': 'chunked'})
+        else:
+            self._send_head(resp, {'Connection': 'close'})
+        try:
+            while True:
+                data = resp.read1(PROXY_CHUNK)
+                if not data:
+                    break
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (OSError, http.client.HTTPException):
+            # 任一端中断：不写结束块，关闭两端，客户端能感知响应不完整
+            conn.close()
+            self.close_connection = True
+            return
+        self.pool.done(conn, resp)
+
+    def log_message(self, format, *args):
+        pass
+
+def proxy_env_path(oroio_dir: str) -> str:
+    return os.path.join(oroio_dir, 'run', 'proxy.env')
+
+def run_proxy(args: list) -> int:
+    """`serve.py proxy <oroio_dir> [--port N] [--upstream URL]`：本机 key 轮换代理。
+    监听 127.0.0.1，地址与访问令牌写入 <oroio_dir>/run/proxy.env（0600）供 dk run 使用"""
+    import atexit
+    if not args:
+        print('Usage: serve.py proxy <oroio_dir> [--port N] [--upstream URL]', file=sys.stderr)
+        return 1
+    oroio_dir = args[0]
+    port, upstream = PROXY_PORT, PROXY_UPSTREAM
+    rest = args[1:]
+    while rest:
+        opt = rest.pop(0)
+        if opt == '--port' and rest:
+            port = int(rest.pop(0))
+        elif opt == '--upstream' and rest:
+            upstream = rest.pop(0)
+        else:
+            print(f'unknown option: {opt}', file=sys.stderr)
+            return 1
+    migrate_key_records(os.path.join(oroio_dir, 'keys.enc'))
+    token = os.environ.get('DKM_PROXY_TOKEN') or secrets.token_urlsafe(24)
+    rotator = KeyRotator(oroio_dir)
+    pool = HTTPPool(upstream, size=PROXY_WORKERS, timeout=PROXY_READ_TIMEOUT)
+    handler = lambda *a, **kw: KeyProxyHandler(*a, rotator=rotator, pool=pool, token=token, **kw)
+    server = PooledHTTPServer(('127.0.0.1', port), handler, workers=PROXY_WORKERS)
+    port = server.server_address[1]
+
+    env_file = proxy_env_path(oroio_dir)
+    os.makedirs(os.path.dirname(env_file), mode=0o700, exist_ok=True)
+    old_umask = os.umask(0o177)
+    try:
+        with open(env_file, 'w') as f:
+            f.write(f'PORT={port}\nTOKEN={token}\nPID={os.getpid()}\n')
+    finally:
+        os.umask(old_umask)
+
+    def cleanup():
+        try:
+            with open(env_file) as f:
+                if f'PID={os.getpid()}' in f.read():
+                    os.unlink(env_file)
+        except OSError:
+            pass
+    atexit.register(cleanup)
+    _exit_on_sigterm()
+    get_usage_poller(oroio_dir).trigger()
+    print(f'key proxy: http://127.0.0.1:{port} -> {upstream}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+# 团队租约协调：多台机器共享同一个 key 池时，由一台机器运行 coordinator 按租约分配 key，
+# 而不是各自在本机 auto_rotate 后都落到同一个 key 上
+COORDINATOR_PORT = int(os.environ.get('DKM_COORDINATOR_PORT', '7760'))
+COORDINATOR_BIND = os.environ.get('DKM_COORDINATOR_BIND', '0.0.0.0')
+LEASE_TTL = int(os.environ.get('DKM_LEASE_TTL', '120'))          # 租约有效期（秒），客户端每 TTL/3 续约一次
+LEASE_MAX_PER_KEY = int(os.environ.get('DKM_LEASE_MAX', '0'))    # 单个 key 同时持有的租约上限（0 不限）
+
+class LeaseCoordinator:
+    """按租约分配 key（pick_least_loaded）。
+    过期未续约的租约在下一次操作时回收；租约表只在内存中，coordinator 重启后客户端续约时按 key id 恢复"""
+    def __init__(self, oroio_dir: str, ttl: int = LEASE_TTL):
+        self.oroio_dir = oroio_dir
+        self.keys_file = os.path.join(oroio_dir, 'keys.enc')
+        self.cache = get_usage_cache(oroio_dir)
+        self.ttl = ttl
+        self.leases = {}  # lease -> {'lease', 'id', 'client', 'granted', 'expires'}
+        self._lock = threading.Lock()
+
+    def _reap(self, now: float):
+        expired = [lease for lease, info in self.leases.items() if info['expires'] <= now]
+        for lease in expired:
+            del self.leases[lease]
+        if expired:
+            METRICS.inc('oroio_lease_reclaimed_total', value=len(expired))
+
+    def _counts(self) -> dict:
+        counts = {}
+        for info in self.leases.values():
+            counts[info['id']] = counts.get(info['id'], 0) + 1
+        return counts
+
+    def _grant(self, record: dict, client: str, now: float, lease: str = None) -> dict:
+        info = {'lease': lease or secrets.token_urlsafe(16), 'id': record['id'], 'client': client[:128],
+                'granted': now, 'expires': now + self.ttl}
+        self.leases[info['lease']] = info
+        return info
+
+    def _describe(self, info: dict, index: int, record: dict) -> dict:
+        entry = self.cache.entry(record['key'])
+        return {'lease': info['lease'], 'id': info['id'], 'index': index, 'key': record['key'],
+                'ttl': self.ttl, 'expires': info['expires'], 'usage': entry['usage'] if entry else None}
+
+    def acquire(self, client: str = '') -> dict:
+        import time
+        records = read_key_records(self.keys_file)
+        if self.cache.stale_keys([r['key'] for r in records]):
+            get_usage_poller(self.oroio_dir).trigger()
+        with self._lock:
+            now = time.time()
+            self._reap(now)
+            index = pick_least_loaded(self.cache, records, self._counts(), now, LEASE_MAX_PER_KEY)
+            if index is None:
+                return None
+            record = records[index - 1]
+            info = self._grant(record, client, now)
+        METRICS.inc('oroio_lease_grants_total')
+        return self._describe(info, index, record)
+
+    def renew(self, lease: str, key_id_: str = None, client: str = '') -> dict:
+        """延长租约；租约已被回收或 coordinator 重启过时，只要客户端带上 key id 且该 key 仍在池中，就按原 id 恢复"""
+        import time
+        records = read_key_records(self.keys_file)
+        with self._lock:
+            now = time.time()
+            self._reap(now)
+            info = self.leases.get(lease)
+            index, record = find_key_record(records, info['id'] if info else key_id_)
+            if record is None:
+                # key 已被删除（或未知租约且没带 id）：租约作废，客户端应重新申请
+                self.leases.pop(lease, None)
+                return None
+            if info is None:
+                info = self._grant(record, client, now, lease)
+                METRICS.inc('oroio_lease_restored_total')
+            info['expires'] = now + self.ttl
+        return self._describe(info, index, record)
+
+    def release(self, lease: str) -> bool:
+        with self._lock:
+            return self.leases.pop(lease, None) is not None
+
+    def snapshot(self) -> list:
+        """每个 key 的租约情况（不含 key 本身），供 /leases 与指标使用"""
+        import time
+        records = read_key_records(self.keys_file)
+        with self._lock:
+            now = time.time()
+            self._reap(now)
+            holders = {}
+            for info in self.leases.values():
+                holders.setdefault(info['id'], []).append(
+                    {'client': info['client'], 'expiresIn': round(info['expires'] - now, 1)})
+        result = []
+        for i, record in enumerate(records):
+            entry = self.cache.entry(record['key'])
+            usage = entry['usage'] if entry else {}
+            result.append({'index': i + 1, 'id': record['id'], 'label': record.get('label', ''),
+                           'key': mask_key(record['key']), 'balance': usage.get('BALANCE_NUM'),
+                           'total': usage.get('TOTAL'), 'leases': holders.get(record['id'], [])})
+        return result
+
+class CoordinatorHandler(PooledKeepAliveMixin, http.server.BaseHTTPRequestHandler):
+    """租约接口（均需 Bearer 令牌）：
+    POST /lease {client} 申请；POST /lease/renew {lease, id} 续约；POST /lease/release {lease} 释放；GET /leases 查看。
+    请求头 Accept: text/plain 时以 KEY=VALUE 行返回，便于 dk 在 bash 中解析。回环地址可免令牌访问 GET /metrics"""
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, coordinator=None, token=None, **kwargs):
+        self.coordinator = coordinator
+        self.token = token
+        super().__init__(*args, **kwargs)
+
+    def _authorized(self) -> bool:
+        import hmac
+        auth = self.headers.get('Authorization', '')
+        given = auth[7:].strip() if auth[:7].lower() == 'bearer ' else ''
+        return hmac.compare_digest(given.encode(), self.token.encode())
+
+    def _reply(self, status: int, data: dict):
+        if 'text/plain' in self.headers.get('Accept', ''):
+            lines = [f'ERROR={data["error"]}'] if 'error' in data else []
+            if 'lease' in data:
+                lines += [f"LEASE={data['lease']}", f"ID={data['id']}", f"INDEX={data['index']}",
+                          f"KEY={data['key']}", f"TTL={data['ttl']}", f"EXPIRES_AT={int(data['expires'])}"]
+                usage = data.get('usage')
+                if usage is not None:
+                    for name in ('BALANCE', 'BALANCE_NUM', 'TOTAL', 'USED', 'EXPIRES', 'RAW'):
+                        lines.append(f'{name}={usage.get(name, "")}')
+            body, ctype = ('\n'.join(lines) + '\n').encode('utf-8'), 'text/plain; charset=utf-8'
+        else:
+            body, ctype = json.dumps(data).encode('utf-8'), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', len(body))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        """读完请求体（Content-Length 或 chunked）并解析为 JSON 对象；chunked 格式错误时抛出 ValueError"""
+        body = read_request_body(self.rfile, self.headers)
+        if not body:
+            return {}
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics' and self.client_address[0] in ('127.0.0.1', '::1', '::ffff:127.0.0.1'):
+            self._send_metrics()
+            return
+        if not self._authorized():
+            self._reply(401, {'error': 'Invalid coordinator token'})
+            return
+        if path == '/leases':
+            self._reply(200, {'ttl': self.coordinator.ttl, 'keys': self.coordinator.snapshot()})
+        else:
+            self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        try:
+            data = self._read_json()
+        except ValueError:
+            self.close_connection = True
+            self._reply(400, {'error': 'Malformed chunked body'})
+            return
+        if not self._authorized():
+            self._reply(401, {'error': 'Invalid coordinator token'})
+            return
+        client = str(data.get('client') or self.client_address[0])
+        if path == '/lease':
+            result = self.coordinator.acquire(client)
+            if result is None:
+                self._reply(503, {'error': 'No usable key available'})
+            else:
+                self._reply(200, result)
+        elif path == '/lease/renew':
+            result = self.coordinator.renew(str(data.get('lease', '')), data.get('id'), client)
+            if result is None:
+                self._reply(404, {'error': 'Lease not found'})
+            else:
+                self._reply(200, result)
+        elif path == '/lease/release':
+            self._reply(200, {'success': self.coordinator.release(str(data.get('lease', '')))})
+        else:
+            self._reply(404, {'error': 'Not found'})
+
+    def _send_metrics(self):
+        gauges = []
+        for key in self.coordinator.snapshot():
+            gauges.append(('oroio_leases_active', {'index': str(key['index']), 'id': key['id']}, len(key['leases'])))
+        body = METRICS.render(gauges).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def coordinator_token(oroio_dir: str) -> str:
+    """团队共享令牌：DKM_COORDINATOR_TOKEN 优先，否则首次启动时生成并保存在 <oroio_dir>/coordinator.token（0600）"""
+    token = os.environ.get('DKM_COORDINATOR_TOKEN')
+    if token:
+        return token
+    path = os.path.join(oroio_dir, 'coordinator.token')
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+    except OSError:
+        token = ''
+    if not token:
+        token = secrets.token_urlsafe(24)
+        old_umask = os.umask(0o177)
+        try:
+            with open(path, 'w') as f:
+                f.write(token + '\n')
+        finally:
+            os.umask(old_umask)
+    return token
+
+def run_coordinator(args: list) -> int:
+    """`serve.py coordinator <oroio_dir> [--port N] [--bind ADDR] [--ttl S]`：团队 key 租约服务"""
+    if not args:
+        print('Usage: serve.py coordinator <oroio_dir> [--port N] [--bind ADDR] [--ttl S]', file=sys.stderr)
+        return 1
+    oroio_dir = args[0]
+    port, bind, ttl = COORDINATOR_PORT, COORDINATOR_BIND, LEASE_TTL
+    rest = args[1:]
+    while rest:
+        opt = rest.pop(0)
+        if opt == '--port' and rest:
+            port = int(rest.pop(0))
+        elif opt == '--bind' and rest:
+            bind = rest.pop(0)
+        elif opt == '--ttl' and rest:
+            ttl = max(10, int(rest.pop(0)))
+        else:
+            print(f'unknown option: {opt}', file=sys.stderr)
+            return 1
+    migrate_key_records(os.path.join(oroio_dir, 'keys.enc'))
+    coordinator = LeaseCoordinator(oroio_dir, ttl=ttl)
+    token = coordinator_token(oroio_dir)
+    handler = lambda *a, **kw: CoordinatorHandler(*a, coordinator=coordinator, token=token, **kw)
+    server = PooledHTTPServer((bind, port), handler)
+    _exit_on_sigterm()
+    get_usage_poller(oroio_dir).trigger()
+    print(f'key coordinator: http://{bind}:{server.server_address[1]} (lease ttl {ttl}s)', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
 def run(port, web_dir, oroio_dir, dk_path, pin_hash=None):
     global PIN_HASH
     PIN_HASH = pin_hash
+    # 旧格式 keys.enc 自动补上稳定 ID
+    migrate_key_records(os.path.join(oroio_dir, 'keys.enc'))
     os.chdir(web_dir)
     
     handler = lambda *args, **kwargs: OroioHandler(
         *args, oroio_dir=oroio_dir, dk_path=dk_path, **kwargs
     )
+    # 启动后台轮询，并立即补齐缺失/过期的条目
+    get_usage_poller(oroio_dir).trigger()
+    _exit_on_sigterm()
+    start_query_socket(oroio_dir)
     
-    with http.server.ThreadingHTTPServer(('0.0.0.0', port), handler) as httpd:
+    with PooledHTTPServer(('0.0.0.0', port), handler) as httpd:
         httpd.serve_forever()
 
+def _exit_on_sigterm():
+    # SIGTERM（dk serve stop）走正常退出流程，以便 atexit 清理 socket
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+def run_daemon(oroio_dir: str) -> int:
+    """`serve.py daemon <oroio_dir>`：只提供本机查询 socket 与后台用量轮询，不启动 Web 服务"""
+    migrate_key_records(os.path.join(oroio_dir, 'keys.enc'))
+    _exit_on_sigterm()
+    server = start_query_socket(oroio_dir)
+    if server is None:
+        print(f'socket 不可用或已有实例在运行: {query_socket_path(oroio_dir)}', file=sys.stderr)
+        return 1
+    get_usage_poller(oroio_dir).trigger()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def cli_usage() -> int:
+    """`serve.py usage`：从 stdin 读取 key（每行一个），并发查询后按 `序号\tbase64` 输出，供 dk 使用"""
+    keys = []
+    for line in sys.stdin:
+        key = line.strip().split('\t')[0]
+        if key:
+            keys.append(key)
+    if not keys:
+        return 0
+    engine = AsyncUsageRefresher()
+    usages = asyncio.run(engine.fetch_all(keys))
+    for i, u in enumerate(usages):
+        sys.stdout.write(f"{i}\t{encode_usage_info(u)}\n")
+    return 0
+
+def cli_import(args: list) -> int:
+    """`serve.py import <oroio_dir> [--validate] [--keep-invalid]`：从 stdin 批量导入 key，供 dk import 使用"""
+    if not args:
+        print('Usage: serve.py import <oroio_dir> [--validate] [--keep-invalid]', file=sys.stderr)
+        return 1
+    oroio_dir = args[0]
+    validate = '--validate' in args
+    keep_invalid = '--keep-invalid' in args
+    candidates = parse_key_text(sys.stdin.read())
+    if not candidates:
+        print('错误: 请提供至少一个key', file=sys.stderr)
+        return 1
+    labels = {'valid': '有效', 'exhausted': '已耗尽', 'invalid': '无效', 'error': '查询失败'}
+
+    def progress(event):
+        sys.stderr.write(f"\r[{event['done']}/{event['count']}] {event['key']} {labels[event['status']]}\033[K")
+        sys.stderr.flush()
+
+    result = import_keys(oroio_dir, candidates, validate=validate, keep_invalid=keep_invalid,
+                         progress=progress if sys.stderr.isatty() else None)
+    if validate and sys.stderr.isatty():
+        sys.stderr.write('\r\033[K')
+    msg = f"已添加 {result['added']} 个key"
+    skipped = result['duplicates'] + result['existing']
+    if skipped:
+        msg += f'，跳过 {skipped} 个重复'
+    if result['invalid']:
+        msg += f"，{'保留' if keep_invalid else '丢弃'} {result['invalid']} 个无效"
+    print(f"{msg}。当前共有 {result['count']} 个key。")
+    return 0
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'usage':
+        sys.exit(cli_usage())
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        sys.exit(cli_import(sys.argv[2:]))
+    if len(sys.argv) > 2 and sys.argv[1] == 'daemon':
+        sys.exit(run_daemon(sys.argv[2]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'proxy':
+        sys.exit(run_proxy(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'coordinator':
+        sys.exit(run_coordinator(sys.argv[2:]))
     if len(sys.argv) < 5:
         print('Usage: serve.py <port> <web_dir> <oroio_dir> <dk_path> [pin_hash]')
         sys.exit(1)
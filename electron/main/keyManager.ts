@@ -39,6 +39,9 @@ function deriveKeyAndIV(salt: Buffer): { key: Buffer; iv: Buffer } {
   };
 }
 
+// keys.enc 每行为 `key<TAB>id=...<TAB>label=...`，写回时保留 key 之后的字段（ID、标签等）
+const recordFields = new Map<string, string>();
+
 export async function decryptKeys(encryptedData: Buffer): Promise<string[]> {
   const header = encryptedData.subarray(0, 8).toString('utf8');
   if (header !== 'Salted__') {
@@ -54,7 +57,12 @@ export async function decryptKeys(encryptedData: Buffer): Promise<string[]> {
   const decrypted = Buffer.concat([decipher.update(ciphertext), decipher.final()]);
   
   const text = decrypted.toString('utf8');
-  return text.split('\n').filter(line => line.trim()).map(line => line.split('\t')[0]);
+  const lines = text.split('\n').filter(line => line.trim());
+  for (const line of lines) {
+    const tab = line.indexOf('\t');
+    if (tab >= 0) recordFields.set(line.slice(0, tab), line.slice(tab + 1).trim());
+  }
+  return lines.map(line => line.split('\t')[0]);
 }
 
 function encryptKeys(keys: string[]): Buffer {
@@ -62,7 +70,7 @@ function encryptKeys(keys: string[]): Buffer {
   const { key, iv } = deriveKeyAndIV(salt);
   
   const cipher = crypto.createCipheriv('aes-256-cbc', key, iv);
-  const text = keys.map(k => `${k}\t`).join('\n');
+  const text = keys.map(k => `${k}\t${recordFields.get(k) ?? ''}`).join('\n');
   const encrypted = Buffer.concat([cipher.update(text, 'utf8'), cipher.final()]);
   
   return Buffer.concat([Buffer.from('Salted__'), salt, encrypted]);
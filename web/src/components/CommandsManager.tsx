@@ -24,6 +24,21 @@ function CommandCard({ cmd, onEdit, onDelete, onCopy, copiedCommand }: {
   copiedCommand: string | null;
 }) {
   const [expanded, setExpanded] = useState(false);
+  const [content, setContent] = useState<string | undefined>(cmd.content);
+
+  useEffect(() => {
+    setContent(cmd.content);
+  }, [cmd]);
+
+  // 列表只返回元数据，展开时再按需加载内容
+  useEffect(() => {
+    if (!expanded || content !== undefined) return;
+    let cancelled = false;
+    getCommandContent(cmd.name)
+      .then((text) => { if (!cancelled) setContent(text); })
+      .catch(() => { if (!cancelled) setContent(''); });
+    return () => { cancelled = true; };
+  }, [expanded, content, cmd.name]);
 
   return (
     <div className="group border-b last:border-b-0 hover:bg-muted/30 transition-colors">
@@ -79,10 +94,10 @@ function CommandCard({ cmd, onEdit, onDelete, onCopy, copiedCommand }: {
         </div>
       </div>
 
-      {expanded && cmd.content && (
+      {expanded && content && (
         <div className="px-4 pb-3 pl-11">
           <pre className="text-xs text-muted-foreground bg-muted/50 rounded-md p-3 overflow-x-auto whitespace-pre-wrap max-h-64">
-            {cmd.content}
+            {content}
           </pre>
         </div>
       )}
@@ -3,8 +3,8 @@ import { Trash2, Plus, RefreshCw, Terminal, CheckCircle2, Copy, Circle, X, Alert
 import { toast } from 'sonner';
 import { sounds } from '@/lib/sound';
 import { decryptKeys, maskKey } from '@/utils/crypto';
-import { fetchEncryptedKeys, fetchCurrentIndex, fetchCache, addKey, removeKey, useKey, refreshCache, isElectron, checkDk } from '@/utils/api';
-import type { KeyInfo } from '@/utils/api';
+import { fetchEncryptedKeys, fetchCurrentIndex, fetchCache, addKey, importKeys, removeKey, useKey, refreshCache, isElectron, checkDk, subscribeEvents } from '@/utils/api';
+import type { ImportResult, KeyInfo } from '@/utils/api';
 import { cn } from '@/lib/utils';
 import { Button } from '@/components/ui/button';
 import { Badge } from '@/components/ui/badge';
@@ -371,6 +371,17 @@ export default function KeyList() {
       });
       return unsubscribe;
     }
+
+    // Apply live deltas pushed by dk serve instead of re-fetching everything
+    return subscribeEvents((event) => {
+      if (event.type === 'usage') {
+        setKeys(prev => prev.map(k => (k.index === event.index ? { ...k, usage: event.usage } : k)));
+      } else if (event.type === 'current') {
+        setKeys(prev => prev.map(k => ({ ...k, isCurrent: k.index === event.index })));
+      } else if (event.type === 'keys') {
+        loadData(false, false, true);
+      }
+    });
   }, [loadData]);
 
   const handleRefresh = async () => {
@@ -383,6 +394,23 @@ export default function KeyList() {
     if (!newKey.trim()) return;
     setAdding(true);
     const lines = newKey.split('\n').map(l => l.trim()).filter(Boolean);
+    if (!isElectron && lines.length > 1) {
+      // 多个 key 走批量导入：服务端去重后只写一次 keys.enc
+      const result = await importKeys(newKey).catch((e: Error) => ({ success: false, error: e.message }) as ImportResult);
+      if (result.success) {
+        setNewKey('');
+        setAddDialogOpen(false);
+        await loadData(true);
+        const skipped = (result.duplicates ?? 0) + (result.existing ?? 0);
+        if (skipped > 0) {
+          alert(`Added ${result.added ?? 0}/${result.received ?? lines.length} keys. Skipped ${skipped} duplicates.`);
+        }
+      } else {
+        alert(`Failed to import keys: ${result.error || 'unknown error'}`);
+      }
+      setAdding(false);
+      return;
+    }
     let successCount = 0;
     let lastError = '';
     for (const key of lines) {
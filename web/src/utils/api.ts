@@ -160,6 +160,41 @@ function parseUsageInfo(text: string): KeyUsage {
   };
 }
 
+function toKeyUsage(u: Record<string, unknown>): KeyUsage {
+  const num = (v: unknown) => (typeof v === 'number' ? v : null);
+  return {
+    balance: num(u['BALANCE_NUM']),
+    total: num(u['TOTAL']),
+    used: num(u['USED']),
+    expires: typeof u['EXPIRES'] === 'string' && u['EXPIRES'] ? u['EXPIRES'] : '?',
+    raw: typeof u['RAW'] === 'string' ? u['RAW'] : '',
+  };
+}
+
+export type ServerEvent =
+  | { type: 'usage'; index: number; usage: KeyUsage }
+  | { type: 'current'; index: number }
+  | { type: 'keys'; count: number }
+  | { type: 'config'; name: string };
+
+// Live deltas from dk serve (/api/events, SSE). Returns an unsubscribe function.
+export function subscribeEvents(onEvent: (event: ServerEvent) => void): () => void {
+  if (isElectron || typeof EventSource === 'undefined') {
+    return () => {};
+  }
+  const token = getAuthToken();
+  const source = new EventSource(token ? `/api/events?token=${encodeURIComponent(token)}` : '/api/events');
+  const parse = (e: Event) => JSON.parse((e as MessageEvent).data);
+  source.addEventListener('usage', (e) => {
+    const data = parse(e);
+    onEvent({ type: 'usage', index: data.index, usage: toKeyUsage(data.usage) });
+  });
+  source.addEventListener('current', (e) => onEvent({ type: 'current', index: parse(e).index }));
+  source.addEventListener('keys', (e) => onEvent({ type: 'keys', count: parse(e).count }));
+  source.addEventListener('config', (e) => onEvent({ type: 'config', name: parse(e).name }));
+  return () => source.close();
+}
+
 export async function addKey(key: string): Promise<{ success: boolean; message?: string; error?: string }> {
   if (isElectron) {
     return window.oroio.keys.add(key);
@@ -172,6 +207,62 @@ export async function addKey(key: string): Promise<{ success: boolean; message?:
   return res.json();
 }
 
+export interface ImportProgress {
+  type: 'key';
+  key: string;
+  status: 'valid' | 'exhausted' | 'invalid' | 'error';
+  balance: number;
+  total: number;
+  done: number;
+  count: number;
+}
+
+export interface ImportResult {
+  success: boolean;
+  error?: string;
+  received?: number;
+  duplicates?: number;
+  existing?: number;
+  invalid?: number;
+  added?: number;
+  count?: number;
+}
+
+// 批量导入（文本，每行一个 key）；validate 时按 NDJSON 逐行回报校验进度
+export async function importKeys(
+  text: string,
+  options: { validate?: boolean; keepInvalid?: boolean; onProgress?: (p: ImportProgress) => void } = {},
+): Promise<ImportResult> {
+  const params = new URLSearchParams();
+  if (options.validate) params.set('validate', '1');
+  if (options.keepInvalid) params.set('keepInvalid', '1');
+  const res = await fetch(`/api/keys/import?${params}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'text/plain', ...getAuthHeaders() },
+    body: text,
+  });
+  if (!options.validate || !res.body) return res.json();
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result: ImportResult = { success: false, error: 'Import interrupted' };
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let nl: number;
+    while ((nl = buffer.indexOf('\n')) >= 0) {
+      const line = buffer.slice(0, nl).trim();
+      buffer = buffer.slice(nl + 1);
+      if (!line) continue;
+      const event = JSON.parse(line);
+      if (event.type === 'done') result = event;
+      else options.onProgress?.(event);
+    }
+  }
+  return result;
+}
+
 export async function removeKey(index: number): Promise<{ success: boolean; message?: string; error?: string }> {
   if (isElectron) {
     return window.oroio.keys.remove(index);
@@ -200,6 +291,7 @@ export async function refreshCache(): Promise<{ success: boolean }> {
   if (isElectron) {
     return window.oroio.keys.refresh();
   }
+  // Server refreshes in the background; fresh usage arrives through the SSE 'usage' events
   const res = await fetch('/api/refresh', { method: 'POST', headers: getAuthHeaders() });
   return res.json();
 }
@@ -207,18 +299,26 @@ export async function refreshCache(): Promise<{ success: boolean }> {
 export interface Skill {
   name: string;
   path: string;
+  description?: string | null;
+  size?: number;
+  mtime?: number;
 }
 
 export interface Command {
   name: string;
   path: string;
-  description?: string;
-  content?: string;
+  description?: string | null;
+  size?: number;
+  mtime?: number;
+  content?: string;  // 列表不再返回正文，按需通过 getCommandContent 获取
 }
 
 export interface Droid {
   name: string;
   path: string;
+  description?: string | null;
+  size?: number;
+  mtime?: number;
 }
 
 export interface McpServer {
@@ -250,7 +350,7 @@ export async function listSkills(): Promise<Skill[]> {
   if (isElectron) {
     return window.oroio.listSkills();
   }
-  const res = await fetch('/api/skills/list', { method: 'POST', headers: getAuthHeaders() });
+  const res = await fetch('/api/skills/list', { headers: getAuthHeaders() });
   return res.json();
 }
 
@@ -285,7 +385,7 @@ export async function listCommands(): Promise<Command[]> {
   if (isElectron) {
     return window.oroio.listCommands();
   }
-  const res = await fetch('/api/commands/list', { method: 'POST', headers: getAuthHeaders() });
+  const res = await fetch('/api/commands/list', { headers: getAuthHeaders() });
   return res.json();
 }
 
@@ -360,7 +460,7 @@ export async function listDroids(): Promise<Droid[]> {
   if (isElectron) {
     return window.oroio.listDroids();
   }
-  const res = await fetch('/api/droids/list', { method: 'POST', headers: getAuthHeaders() });
+  const res = await fetch('/api/droids/list', { headers: getAuthHeaders() });
   return res.json();
 }
 
@@ -395,8 +495,10 @@ export async function listMcpServers(): Promise<McpServer[]> {
   if (isElectron) {
     return window.oroio.listMcpServers();
   }
-  const res = await fetch('/api/mcp/list', { method: 'POST', headers: getAuthHeaders() });
-  return res.json();
+  const res = await fetch('/api/mcp/list', { headers: getAuthHeaders() });
+  const data = await res.json();
+  if (!res.ok) throw new Error(data.error);
+  return data;
 }
 
 export async function addMcpServer(name: string, command: string, args: string[]): Promise<void> {
@@ -443,8 +545,10 @@ export async function listCustomModels(): Promise<CustomModel[]> {
   if (isElectron) {
     return window.oroio.listCustomModels();
   }
-  const res = await fetch('/api/byok/list', { method: 'POST', headers: getAuthHeaders() });
-  return res.json();
+  const res = await fetch('/api/byok/list', { headers: getAuthHeaders() });
+  const data = await res.json();
+  if (!res.ok) throw new Error(data.error);
+  return data;
 }
 
 export async function removeCustomModel(index: number): Promise<void> {